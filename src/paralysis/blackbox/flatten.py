@@ -0,0 +1,136 @@
+import json
+import re
+from typing import Iterable, Iterator
+
+import pandas as pd
+
+# Separates the levels of a nested feedback key in `feedback_leaves` paths.
+# Not "/", since tallies are often keyed by type paths.
+PATH_SEPARATOR = "|"
+
+# Strings that are stored as integers, e.g. PR numbers and counts sent as text.
+INTEGER_STRING = re.compile(r"-?\d{1,18}")
+
+
+def _flatten_value(value, prefix="") -> dict:
+    if isinstance(value, dict):
+        flat = dict()
+        for k, v in value.items():
+            flat.update(_flatten_value(v, f"{prefix}{k}."))
+        return flat
+    name = prefix[:-1] if prefix else "value"
+    if isinstance(value, list):
+        # Lists don't have a fixed shape, so keep them as JSON text
+        return {name: json.dumps(value)}
+    return {name: value}
+
+
+def flatten_feedback(round_id: int, data) -> list[dict]:
+    """
+    Flatten the `data` of one feedback payload into rows. Each top-level entry
+    becomes a row with its name in `key` and any nested dicts spread out into
+    dot-separated columns, e.g. `manifest` becomes rows of `key` (the job),
+    `roundstart` and `latejoin`. Plain values end up in a `value` column.
+    """
+    if isinstance(data, dict):
+        entries = data.items()
+    elif isinstance(data, list):
+        entries = ((str(i), v) for i, v in enumerate(data))
+    else:
+        return [{"round_id": round_id, "value": data}]
+
+    return [
+        {"round_id": round_id, "key": str(k), **_flatten_value(v)} for k, v in entries
+    ]
+
+
+def _value_dtype(value) -> str | None:
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "Int64" if -(2**63) <= value < 2**63 else "string"
+    if isinstance(value, float):
+        return "Float64"
+    if isinstance(value, str) and INTEGER_STRING.fullmatch(value):
+        return "Int64"
+    return "string"
+
+
+def _merge_dtypes(a: str | None, b: str | None) -> str | None:
+    if a is None or a == b:
+        return b
+    if b is None:
+        return a
+    if {a, b} == {"Int64", "Float64"}:
+        return "Float64"
+    return "string"
+
+
+def feedback_dtypes(rows: Iterable[dict]) -> dict[str, str]:
+    """
+    The column dtypes of a frame of `flatten_feedback` rows, in order of
+    first appearance. Integers and integer strings become nullable integers,
+    mixed with floats they become nullable floats, and columns mixing any
+    other types fall back to strings. `rows` may be a generator, so one
+    schema can be worked out for a whole feedback key without holding it.
+    """
+    dtypes = {"round_id": "int64", "key": None}
+    for row in rows:
+        for column, value in row.items():
+            if column != "round_id":
+                dtypes[column] = _merge_dtypes(dtypes.get(column), _value_dtype(value))
+    # Columns that are always missing, and `key`, are strings.
+    return {column: dtype or "string" for column, dtype in dtypes.items()}
+
+
+def _convert(value, dtype: str):
+    if value is None:
+        return None
+    if dtype == "string":
+        return value if isinstance(value, str) else str(value)
+    if dtype == "Int64":
+        return int(value)
+    if dtype == "Float64":
+        return float(value)
+    return value
+
+
+def feedback_frame(
+    rows: list[dict], dtypes: dict[str, str] | None = None
+) -> pd.DataFrame:
+    """
+    Build a DataFrame from `flatten_feedback` rows with the columns and types
+    of `dtypes`, by default the `feedback_dtypes` of `rows`. Passing the same
+    `dtypes` for every chunk or partition of a key gives them all the same
+    columns and types, with missing columns left empty.
+    """
+    if dtypes is None:
+        dtypes = feedback_dtypes(rows)
+    return pd.DataFrame(
+        {
+            column: pd.array(
+                [_convert(row.get(column), dtype) for row in rows], dtype=dtype
+            )
+            for column, dtype in dtypes.items()
+        }
+    )
+
+
+def feedback_leaves(data, prefix: str = "") -> Iterator[tuple[str, object]]:
+    """
+    Yield `(path, value)` for every leaf of a feedback payload's `data`, where
+    `path` joins the dict keys and list indices leading to it with
+    `PATH_SEPARATOR`, e.g. `("iron|drill", 10)` for a nested tally.
+    """
+    if isinstance(data, dict):
+        entries = data.items()
+    elif isinstance(data, list):
+        entries = enumerate(data)
+    else:
+        yield prefix, data
+        return
+
+    for k, v in entries:
+        yield from feedback_leaves(v, f"{prefix}{PATH_SEPARATOR}{k}" if prefix else str(k))
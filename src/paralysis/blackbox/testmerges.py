@@ -1,58 +1,403 @@
-from sqlalchemy import create_engine, and_
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import Engine, select
 from sqlalchemy.orm import Session
+import numpy as np
 import pandas as pd
 import click
 import typed_settings as ts
 
-from paralysis.settings import ParalysisSettings
-from paralysis.model import Feedback
-
+from paralysis.settings import ParalysisSettings, create_database_engine
+from paralysis.model import ProfilerRoundRollup, Round, RoundSummary, RoundTestmerge
 
-def filter_pr(pr):
-    def apply(x):
-        return {
-            "pr": testmerge
-            for testmerge in x["data"].values()
-            if str(testmerge["number"]) == str(pr)
-        }
+# How far before and after a PR's testmerged rounds its baseline extends
+BASELINE_PADDING = timedelta(days=7)
 
-    return apply
+# `round_summary` columns compared between testmerged and baseline rounds
+SUMMARY_METRICS = [
+    "duration_seconds",
+    "roundstart_player_count",
+    "roundend_player_count",
+    "highest_player_count",
+]
 
 
 def get_tm_rounds(engine, pr):
     with Session(engine) as session:
         query = (
-            session.query(Feedback.round_id, Feedback.json, Feedback.datetime)
-            .where(
-                and_(
-                    Feedback.key_name == "testmerged_prs",
-                    Feedback.json["data"].regexp_match(f'"number": "{pr}"'),
-                )
+            select(
+                RoundTestmerge.round_id,
+                Round.start_datetime,
+                RoundTestmerge.pr_number,
+                RoundTestmerge.commit,
+                RoundTestmerge.title,
             )
-            .order_by(Feedback.round_id)
+            .join(Round, Round.id == RoundTestmerge.round_id)
+            .where(RoundTestmerge.pr_number == int(pr))
+            .order_by(RoundTestmerge.round_id)
         )
-        testmerged_rounds = pd.read_sql_query(query.statement, session.connection())
+        testmerged_rounds = pd.read_sql_query(query, session.connection())
 
         return testmerged_rounds
 
 
 def get(pr: str, connection_string: str):
-    engine = create_engine(connection_string)
+    engine = create_database_engine(connection_string)
     tm_rounds = get_tm_rounds(engine, pr)
-    tm_rounds = tm_rounds.join(
-        pd.json_normalize(tm_rounds.json.map(filter_pr(pr)))
-    ).drop(["json"], axis=1)
     unique_rounds = len(tm_rounds.round_id.unique())
     print(tm_rounds.round_id.unique())
     print(f"{unique_rounds} rounds.")
 
 
+def load_testmerge_rounds(
+    engine: Engine,
+    prs: list[int] | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+) -> pd.DataFrame:
+    """
+    The `(round_id, pr_number, title, start_datetime)` of every round
+    testmerging one of `prs`, or any PR if `prs` isn't given, that started
+    between `start` and `end`.
+    """
+    query = select(
+        RoundTestmerge.round_id,
+        RoundTestmerge.pr_number,
+        RoundTestmerge.title,
+        Round.start_datetime,
+    ).join(Round, Round.id == RoundTestmerge.round_id)
+    if prs is not None:
+        query = query.where(RoundTestmerge.pr_number.in_(prs))
+    if start is not None:
+        query = query.where(Round.start_datetime >= start)
+    if end is not None:
+        query = query.where(Round.start_datetime < end)
+
+    with engine.connect() as conn:
+        tm_rounds = pd.read_sql_query(query, conn, parse_dates=["start_datetime"])
+    return tm_rounds.drop_duplicates(["round_id", "pr_number"])
+
+
+def load_round_metrics(engine: Engine, start: datetime, end: datetime) -> pd.DataFrame:
+    """
+    Numeric metrics for every round with a `round_summary` that started
+    between `start` and `end` inclusive, indexed by round id and sorted by
+    start time: the `SUMMARY_METRICS`, one `end_state:<state>` indicator
+    column per end state, and the mean `self_cpu:<proc>` and
+    `overtime:<proc>` of each profiled proc.
+    """
+    summaries = select(
+        RoundSummary.round_id,
+        RoundSummary.start_datetime,
+        RoundSummary.end_state,
+        *(RoundSummary.__table__.c[c] for c in SUMMARY_METRICS),
+    ).where(RoundSummary.start_datetime.between(start, end))
+    profiler = (
+        select(
+            ProfilerRoundRollup.round_id,
+            ProfilerRoundRollup.proc_path,
+            ProfilerRoundRollup.metric,
+            (ProfilerRoundRollup.value_sum / ProfilerRoundRollup.sample_count).label(
+                "mean"
+            ),
+        )
+        .join(RoundSummary, RoundSummary.round_id == ProfilerRoundRollup.round_id)
+        .where(
+            RoundSummary.start_datetime.between(start, end),
+            ProfilerRoundRollup.metric.in_(["self_cpu", "overtime"]),
+        )
+    )
+
+    with engine.connect() as conn:
+        metrics = pd.read_sql_query(
+            summaries, conn, index_col="round_id", parse_dates=["start_datetime"]
+        )
+        samples = pd.read_sql_query(profiler, conn)
+
+    metrics[SUMMARY_METRICS] = metrics[SUMMARY_METRICS].astype("float64")
+    end_states = pd.get_dummies(
+        metrics.pop("end_state"), prefix="end_state", prefix_sep=":", dtype="float64"
+    )
+    metrics = metrics.join(end_states)
+
+    if len(samples):
+        per_proc = samples.pivot(
+            index="round_id", columns=["metric", "proc_path"], values="mean"
+        )
+        per_proc.columns = [f"{metric}:{proc}" for metric, proc in per_proc.columns]
+        metrics = metrics.join(per_proc.astype("float64"))
+
+    return metrics.sort_values("start_datetime", kind="stable")
+
+
+def testmerge_report(
+    tm_rounds: pd.DataFrame,
+    metrics: pd.DataFrame,
+    padding: timedelta = BASELINE_PADDING,
+    testmerged: pd.DataFrame | None = None,
+) -> pd.DataFrame:
+    """
+    Compare each PR's testmerged rounds to its baseline: the rounds in
+    `metrics` that started from `padding` before its first testmerged round
+    to `padding` after its last, but didn't testmerge it. For every metric
+    column the report has the mean over testmerged rounds, the baseline mean,
+    and their difference.
+
+    `testmerged` holds every round testmerging each PR, in case `tm_rounds`
+    only has some of them, e.g. the ones in a date range. Those left out of
+    `tm_rounds` aren't reported on but are still kept out of the baseline.
+
+    Window totals come from cumulative sums over the time-sorted `metrics`,
+    so all PRs are compared at once without a pass over the rounds per PR.
+    """
+    columns = [c for c in metrics.columns if c != "start_datetime"]
+    tm_rounds = tm_rounds[tm_rounds.round_id.isin(metrics.index)]
+
+    values = metrics[columns].to_numpy(dtype="float64")
+    present = ~np.isnan(values)
+    zero = np.zeros((1, len(columns)))
+    value_sums = np.vstack([zero, np.nan_to_num(values).cumsum(axis=0)])
+    value_counts = np.vstack([zero, present.cumsum(axis=0)])
+    round_counts = np.arange(len(metrics) + 1)
+
+    prs = tm_rounds.groupby("pr_number").agg(
+        title=("title", "first"),
+        first_round_start=("start_datetime", "min"),
+        last_round_start=("start_datetime", "max"),
+        rounds=("round_id", "size"),
+    )
+    times = metrics["start_datetime"].to_numpy()
+    lo = np.searchsorted(
+        times, (prs.first_round_start - padding).to_numpy(), side="left"
+    )
+    hi = np.searchsorted(
+        times, (prs.last_round_start + padding).to_numpy(), side="right"
+    )
+
+    tm_values = metrics.loc[tm_rounds.round_id, columns].set_axis(tm_rounds.pr_number)
+    tm_sums = tm_values.groupby(level=0).sum().loc[prs.index].to_numpy()
+    tm_counts = tm_values.groupby(level=0).count().loc[prs.index].to_numpy()
+
+    # Every testmerged round of a PR inside its window is left out of its
+    # baseline, including ones that aren't reported on.
+    if testmerged is None:
+        testmerged = tm_rounds
+    testmerged = testmerged[
+        testmerged.round_id.isin(metrics.index) & testmerged.pr_number.isin(prs.index)
+    ]
+    position = metrics.index.get_indexer(testmerged.round_id)
+    pr_index = prs.index.get_indexer(testmerged.pr_number)
+    testmerged = testmerged[(position >= lo[pr_index]) & (position < hi[pr_index])]
+    all_tm_values = metrics.loc[testmerged.round_id, columns].set_axis(
+        testmerged.pr_number
+    )
+    by_pr = all_tm_values.groupby(level=0)
+    all_tm_sums = by_pr.sum().reindex(prs.index, fill_value=0)
+    all_tm_counts = by_pr.count().reindex(prs.index, fill_value=0)
+    all_tm_rounds = testmerged.pr_number.value_counts().reindex(prs.index, fill_value=0)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        tm_means = tm_sums / tm_counts
+        baseline_means = (value_sums[hi] - value_sums[lo] - all_tm_sums.to_numpy()) / (
+            value_counts[hi] - value_counts[lo] - all_tm_counts.to_numpy()
+        )
+
+    report = prs.assign(
+        baseline_rounds=round_counts[hi] - round_counts[lo] - all_tm_rounds.to_numpy()
+    )
+    for i, column in enumerate(columns):
+        report[column] = tm_means[:, i]
+        report[f"{column}:baseline"] = baseline_means[:, i]
+        report[f"{column}:change"] = tm_means[:, i] - baseline_means[:, i]
+    return report
+
+
+def write_report(
+    engine: Engine,
+    output_dir: Path,
+    prs: list[int] | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    output_format: str = "csv",
+):
+    """
+    Write `summary.<format>` with one row per PR from `testmerge_report`, and
+    `pr_<number>.<format>` with the metrics of each PR's testmerged rounds.
+    `start` and `end` pick the testmerged rounds reported on, but rounds
+    testmerging the same PRs outside them still don't count as baseline.
+    """
+    tm_rounds = load_testmerge_rounds(engine, prs, start, end)
+    if tm_rounds.empty:
+        print("No testmerged rounds found.")
+        return
+    testmerged = load_testmerge_rounds(engine, tm_rounds.pr_number.unique().tolist())
+
+    metrics = load_round_metrics(
+        engine,
+        tm_rounds.start_datetime.min() - BASELINE_PADDING,
+        tm_rounds.start_datetime.max() + BASELINE_PADDING,
+    )
+    report = testmerge_report(tm_rounds, metrics, testmerged=testmerged)
+
+    def write(df: pd.DataFrame, name: str):
+        if output_format == "parquet":
+            df.to_parquet(output_dir / f"{name}.parquet")
+        else:
+            df.to_csv(output_dir / f"{name}.csv")
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    write(report, "summary")
+    for pr_number, rounds in tm_rounds.groupby("pr_number"):
+        write(metrics[metrics.index.isin(rounds.round_id)], f"pr_{pr_number}")
+    print(f"Wrote report for {len(report)} PRs to {output_dir}.")
+
+
+def load_profile_comparison_rounds(
+    engine: Engine, pr: int, procs: list[str], padding: timedelta = BASELINE_PADDING
+) -> pd.DataFrame:
+    """
+    Per-round profiler medians of `procs` for the rounds testmerging `pr` and
+    for the rounds on the same maps that started within `padding` of them
+    without it, with a boolean `testmerged` column telling them apart.
+    """
+    tm_rounds = load_testmerge_rounds(engine, [pr])
+    if tm_rounds.empty:
+        return pd.DataFrame()
+
+    tm_maps = select(Round.map_name).where(
+        Round.id.in_(tm_rounds.round_id.tolist())
+    )
+    query = (
+        select(
+            Round.id.label("round_id"),
+            Round.map_name,
+            ProfilerRoundRollup.proc_path,
+            ProfilerRoundRollup.metric,
+            ProfilerRoundRollup.p50.label("value"),
+        )
+        .join(ProfilerRoundRollup, ProfilerRoundRollup.round_id == Round.id)
+        .where(
+            Round.start_datetime.between(
+                tm_rounds.start_datetime.min() - padding,
+                tm_rounds.start_datetime.max() + padding,
+            ),
+            Round.map_name.in_(tm_maps),
+            ProfilerRoundRollup.proc_path.in_(procs),
+            ProfilerRoundRollup.p50.is_not(None),
+        )
+    )
+    with engine.connect() as conn:
+        rounds = pd.read_sql_query(query, conn)
+
+    rounds["value"] = rounds["value"].astype("float64")
+    rounds["testmerged"] = rounds.round_id.isin(tm_rounds.round_id)
+    return rounds
+
+
+def profile_effect_sizes(rounds: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compare testmerged and baseline rounds per map, proc and metric: sample
+    sizes, means and medians of each side, the relative change in median,
+    Hedges' g, and Cliff's delta (from Mann-Whitney U, with ranks computed
+    for all groups at once). Positive effects mean the testmerge was slower.
+    """
+    keys = ["map_name", "proc_path", "metric"]
+    stat_names = ["size", "mean", "std", "median"]
+    stats = (
+        rounds.groupby([*keys, "testmerged"])["value"]
+        .agg(stat_names)
+        .unstack("testmerged")
+        .reindex(columns=pd.MultiIndex.from_product([stat_names, [True, False]]))
+    )
+    stats.columns = [
+        f"{stat}:{'testmerged' if tm else 'baseline'}" for stat, tm in stats.columns
+    ]
+    stats = stats.dropna(subset=["size:testmerged", "size:baseline"])
+
+    n_tm, n_base = stats["size:testmerged"], stats["size:baseline"]
+    pooled_var = (
+        (n_tm - 1) * stats["std:testmerged"] ** 2
+        + (n_base - 1) * stats["std:baseline"] ** 2
+    ) / (n_tm + n_base - 2)
+    pooled_sd = np.sqrt(pooled_var)
+    correction = 1 - 3 / (4 * (n_tm + n_base) - 9)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        stats["median_change"] = stats["median:testmerged"] / stats["median:baseline"] - 1
+        stats["hedges_g"] = (
+            (stats["mean:testmerged"] - stats["mean:baseline"]) / pooled_sd * correction
+        )
+
+    ranked = rounds.assign(rank=rounds.groupby(keys)["value"].rank())
+    rank_sums = ranked[ranked.testmerged].groupby(keys)["rank"].sum()
+    u = rank_sums.reindex(stats.index) - n_tm * (n_tm + 1) / 2
+    stats["cliffs_delta"] = 2 * u / (n_tm * n_base) - 1
+
+    return stats.reset_index()
+
+
+@click.command()
+@click.option("--settings", required=True, help="Location of your settings.toml file.")
+@click.option("--pr", "prs", type=int, multiple=True, help="May be given more than once.")
+@click.option("--start", type=click.DateTime(), help="Only rounds started on or after this.")
+@click.option("--end", type=click.DateTime(), help="Only rounds started before this.")
+@click.option("--output_dir", type=Path, help="Write a comparison report here.")
+@click.option("--format", "output_format", type=click.Choice(["csv", "parquet"]), default="csv")
+def main(
+    settings: str,
+    prs: tuple[int],
+    start: datetime | None,
+    end: datetime | None,
+    output_dir: Path | None,
+    output_format: str,
+):
+    settings: ParalysisSettings = ts.load(
+        ParalysisSettings, appname="paralysis", config_files=[settings]
+    )
+
+    if output_dir is None:
+        if not prs:
+            raise click.UsageError("--pr is required without --output_dir")
+        for pr in prs:
+            get(pr, settings.connection_string)
+        return
+
+    if not (prs or start or end):
+        raise click.UsageError("give --pr, or --start/--end to report on every PR")
+    engine = create_database_engine(settings.connection_string)
+    write_report(engine, output_dir, list(prs) or None, start, end, output_format)
+
+
 @click.command()
 @click.option("--settings", required=True, help="Location of your settings.toml file.")
-@click.option("--pr", required=True)
-def main(settings: str, pr: str):
+@click.option("--pr", type=int, required=True)
+@click.option("--output", type=Path, help="Write the comparison to this CSV file.")
+def profiles_main(settings: str, pr: int, output: Path | None):
     settings: ParalysisSettings = ts.load(
         ParalysisSettings, appname="paralysis", config_files=[settings]
     )
+    engine = create_database_engine(settings.connection_string)
 
-    get(pr, settings.connection_string)
+    rounds = load_profile_comparison_rounds(engine, pr, settings.profile_proc_paths)
+    if rounds.empty or not rounds.testmerged.any():
+        print(f"No profiled testmerged rounds found for PR {pr}.")
+        return
+
+    report = profile_effect_sizes(rounds)
+    if output is not None:
+        report.to_csv(output, index=False)
+    with pd.option_context("display.max_rows", None, "display.width", None):
+        print(
+            report[
+                [
+                    "map_name",
+                    "proc_path",
+                    "metric",
+                    "size:testmerged",
+                    "size:baseline",
+                    "median_change",
+                    "hedges_g",
+                    "cliffs_delta",
+                ]
+            ]
+        )
@@ -0,0 +1,178 @@
+"""
+Chunked DataFrame loaders for rounds, population samples and feedback.
+
+Every `iter_*` function streams its query with a server-side cursor and
+yields one DataFrame per `chunksize` rows, selecting only the requested
+columns and giving every chunk the same explicit dtypes. The matching `load_*` functions
+concatenate the chunks for when the result fits in memory.
+"""
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, Iterator, Sequence
+
+import pandas as pd
+from sqlalchemy import Engine, Select, select
+
+from paralysis.blackbox.flatten import feedback_dtypes, feedback_frame, flatten_feedback
+from paralysis.model import Feedback, LegacyPopulation, Round
+
+ROUND_DTYPES = {
+    "id": "int64",
+    "initialize_datetime": "datetime64[ns]",
+    "start_datetime": "datetime64[ns]",
+    "shutdown_datetime": "datetime64[ns]",
+    "end_datetime": "datetime64[ns]",
+    "server_ip": "int64",
+    "server_port": "int32",
+    "commit_hash": "string",
+    "game_mode": "string",
+    "game_mode_result": "string",
+    "end_state": "string",
+    "shuttle_name": "string",
+    "map_name": "string",
+    "station_name": "string",
+    "server_id": "string",
+}
+
+POPULATION_DTYPES = {
+    "round_id": "int64",
+    "time": "datetime64[ns]",
+    "playercount": "Int32",
+    "admincount": "Int32",
+}
+
+
+@dataclass(frozen=True)
+class RoundFilter:
+    """Which rounds to load. Unset fields don't filter anything."""
+
+    start: datetime | None = None
+    end: datetime | None = None
+    map_names: Sequence[str] | None = None
+    game_modes: Sequence[str] | None = None
+    min_round_id: int | None = None
+    max_round_id: int | None = None
+
+    def apply(self, query: Select) -> Select:
+        """Add this filter's conditions on `Round` to `query`."""
+        if self.start is not None:
+            query = query.where(Round.start_datetime >= self.start)
+        if self.end is not None:
+            query = query.where(Round.start_datetime < self.end)
+        if self.map_names is not None:
+            query = query.where(Round.map_name.in_(list(self.map_names)))
+        if self.game_modes is not None:
+            query = query.where(Round.game_mode.in_(list(self.game_modes)))
+        if self.min_round_id is not None:
+            query = query.where(Round.id >= self.min_round_id)
+        if self.max_round_id is not None:
+            query = query.where(Round.id <= self.max_round_id)
+        return query
+
+
+def _read_chunks(
+    engine: Engine, query: Select, dtypes: dict, chunksize: int
+) -> Iterator[pd.DataFrame]:
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        for chunk in pd.read_sql_query(query, conn, chunksize=chunksize):
+            yield chunk.astype({k: v for k, v in dtypes.items() if k in chunk})
+
+
+def iter_rounds(
+    engine: Engine,
+    filters: RoundFilter = RoundFilter(),
+    columns: Iterable[str] | None = None,
+    chunksize: int = 50_000,
+) -> Iterator[pd.DataFrame]:
+    """Stream `round` rows matching `filters`, limited to `columns` if given."""
+    columns = list(columns or ROUND_DTYPES)
+    if "id" not in columns:
+        columns.insert(0, "id")
+    query = filters.apply(select(*(Round.__table__.c[c] for c in columns)))
+    yield from _read_chunks(engine, query.order_by(Round.id), ROUND_DTYPES, chunksize)
+
+
+def load_rounds(engine: Engine, filters: RoundFilter = RoundFilter(), **kwargs):
+    return _concat(iter_rounds(engine, filters, **kwargs))
+
+
+def iter_populations(
+    engine: Engine, filters: RoundFilter = RoundFilter(), chunksize: int = 200_000
+) -> Iterator[pd.DataFrame]:
+    """Stream the population samples of the rounds matching `filters`."""
+    query = filters.apply(
+        select(
+            LegacyPopulation.round_id,
+            LegacyPopulation.time,
+            LegacyPopulation.playercount,
+            LegacyPopulation.admincount,
+        ).join(Round, Round.id == LegacyPopulation.round_id)
+    ).order_by(LegacyPopulation.round_id, LegacyPopulation.time)
+    yield from _read_chunks(engine, query, POPULATION_DTYPES, chunksize)
+
+
+def load_populations(engine: Engine, filters: RoundFilter = RoundFilter(), **kwargs):
+    return _concat(iter_populations(engine, filters, **kwargs))
+
+
+def _feedback_rows(
+    engine: Engine, key_name: str, filters: RoundFilter, chunksize: int
+) -> Iterator[list[dict]]:
+    query = filters.apply(
+        select(Feedback.round_id, Feedback.json, Feedback.json_compressed)
+        .join(Round, Round.id == Feedback.round_id)
+        .where(Feedback.key_name == key_name)
+    ).order_by(Feedback.round_id)
+
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=chunksize).execute(
+            query
+        )
+        for partition in result.partitions():
+            rows = list()
+            for round_id, json_value, json_compressed in partition:
+                data = Feedback.decode(json_value, json_compressed)["data"]
+                rows.extend(flatten_feedback(round_id, data))
+            yield rows
+
+
+def iter_feedback(
+    engine: Engine,
+    key_name: str,
+    filters: RoundFilter = RoundFilter(),
+    chunksize: int = 5_000,
+    dtypes: dict[str, str] | None = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    Stream one feedback key for the rounds matching `filters`, flattened with
+    `flatten_feedback` so each top-level entry is a row. `chunksize` counts
+    feedback rows, not flattened rows.
+
+    Every chunk gets the columns and types in `dtypes`. Without them, they
+    are worked out with `feedback_dtypes` in a first pass over the same
+    rounds, so pass them in to read the feedback only once.
+    """
+    if dtypes is None:
+        dtypes = feedback_dtypes(
+            row
+            for rows in _feedback_rows(engine, key_name, filters, chunksize)
+            for row in rows
+        )
+    for rows in _feedback_rows(engine, key_name, filters, chunksize):
+        if rows:
+            yield feedback_frame(rows, dtypes)
+
+
+def load_feedback(
+    engine: Engine, key_name: str, filters: RoundFilter = RoundFilter(), **kwargs
+):
+    return _concat(iter_feedback(engine, key_name, filters, **kwargs))
+
+
+def _concat(chunks: Iterator[pd.DataFrame]) -> pd.DataFrame:
+    chunks = list(chunks)
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks, ignore_index=True)
@@ -1,30 +1,77 @@
-from functools import cache
+from datetime import datetime, timezone
 import json
-from typing import List, Optional
+import math
+from typing import Iterable, List, Optional
+import zlib
+
+import numpy as np
 
 # coding: utf-8
 from sqlalchemy import (
     CHAR,
     Column,
+    Date,
     DateTime,
     Double,
     Enum,
     Float,
     ForeignKey,
+    Index,
+    LargeBinary,
+    SmallInteger,
     String,
     Text,
     text,
 )
-from sqlalchemy.dialects.mysql import INTEGER, JSON, MEDIUMTEXT, SMALLINT, TINYINT
+from sqlalchemy.dialects.mysql import (
+    INTEGER,
+    JSON,
+    MEDIUMBLOB,
+    MEDIUMTEXT,
+    SMALLINT,
+    TINYINT,
+)
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import Mapped, mapped_column, relationship, Session
-from sqlalchemy import Engine
+from sqlalchemy.orm import (
+    Mapped,
+    joinedload,
+    mapped_column,
+    noload,
+    relationship,
+    selectinload,
+    Session,
+)
+from sqlalchemy import Engine, Select, insert, select
 
+from paralysis.blackbox.flatten import feedback_leaves
 from paralysis.network import CachedLimiterSession
 
 Base = declarative_base()
 metadata = Base.metadata
 
+# MySQL types that other databases can't render, with generic equivalents so
+# the schema can also be created in a local SQLite file.
+MYSQL_DIALECTS = ("mysql", "mariadb")
+TinyInt = SmallInteger().with_variant(TINYINT(3), *MYSQL_DIALECTS)
+MediumText = Text().with_variant(MEDIUMTEXT(), *MYSQL_DIALECTS)
+MediumBlob = LargeBinary().with_variant(MEDIUMBLOB(), *MYSQL_DIALECTS)
+
+
+def parse_api_datetime(value: str | datetime | None) -> datetime | None:
+    """
+    Parse a timestamp from the Parastats API into a naive datetime, converting
+    it to UTC if it has an offset. Not every database accepts strings for
+    datetime columns.
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
 
 class Death(Base):
     __tablename__ = "death"
@@ -50,6 +97,10 @@ class Death(Base):
 
 class Feedback(Base):
     __tablename__ = "feedback"
+    __table_args__ = (
+        Index("ix_feedback_key_name", "key_name"),
+        Index("ix_feedback_round_id_key_name", "round_id", "key_name"),
+    )
 
     id = Column(INTEGER(11), primary_key=True)
     datetime = Column(DateTime, nullable=False)
@@ -67,8 +118,11 @@ class Feedback(Base):
         ),
         nullable=False,
     )
-    version = Column(TINYINT(3), nullable=False)
-    json = Column(JSON, nullable=False)
+    version = Column(TinyInt, nullable=False)
+    # Exactly one of these is set. Large payloads may be stored as
+    # zlib-compressed raw JSON instead; use `payload()` to read either.
+    json = Column(JSON)
+    json_compressed = Column(MediumBlob)
 
     round: Mapped["Round"] = relationship(back_populates="feedbacks")
 
@@ -79,14 +133,44 @@ class Feedback(Base):
         return self.__str__()
 
     def __getitem__(self, key):
-        return self.json["data"].__getitem__(key)
+        return self.json_data().__getitem__(key)
 
     def get(self, key, default=None):
-        return self.json["data"].get(key, default)
+        return self.json_data().get(key, default)
+
+    @staticmethod
+    def from_raw(
+        raw_data: str, compress_threshold: int | None = None, **kwargs
+    ) -> "Feedback":
+        """
+        Create a feedback row from the raw JSON string returned by the API,
+        compressing it if it is at least `compress_threshold` bytes long.
+        """
+        if compress_threshold is not None and len(raw_data) >= compress_threshold:
+            return Feedback(json_compressed=zlib.compress(raw_data.encode()), **kwargs)
+        return Feedback(json=json.loads(raw_data), **kwargs)
+
+    @staticmethod
+    def decode(json_value, json_compressed: bytes | None) -> dict:
+        """The payload stored in a row's `json` and `json_compressed` columns."""
+        if json_compressed is not None:
+            return json.loads(zlib.decompress(json_compressed))
+        return json_value
+
+    def payload(self) -> dict:
+        return Feedback.decode(self.json, self.json_compressed)
 
-    @cache
     def json_data(self):
-        return self.json["data"]
+        """
+        The parsed `data` of the payload. Cached on the instance, so it is
+        freed along with the row, and re-parsed if the payload is replaced.
+        """
+        source = self.json if self.json_compressed is None else self.json_compressed
+        cached = self.__dict__.get("_json_data")
+        if cached is None or cached[0] is not source:
+            cached = (source, self.payload()["data"])
+            self.__dict__["_json_data"] = cached
+        return cached[1]
 
     def keys(self):
         return self.json_data().keys()
@@ -98,21 +182,87 @@ class Feedback(Base):
         return self.json_data().items()
 
 
+class FeedbackValue(Base):
+    """
+    One leaf of a tally, nested tally, associative or ledger feedback payload,
+    so aggregates across rounds can be done in SQL. `path` joins the keys
+    leading to the leaf with `PATH_SEPARATOR` from `paralysis.blackbox.flatten`.
+    Numeric leaves go in `value`, and string leaves are kept as they were in
+    `text_value`, even if they could also be read as a number.
+    """
+
+    __tablename__ = "feedback_value"
+    __table_args__ = (Index("ix_feedback_value_key_name_path", "key_name", "path"),)
+
+    NORMALIZED_KEY_TYPES = ("tally", "nested tally", "associative", "ledger")
+
+    id = Column(INTEGER(11), primary_key=True)
+    round_id: Mapped[int] = mapped_column(ForeignKey("round.id"), index=True)
+    key_name = Column(String(32), nullable=False)
+    path = Column(String(255), nullable=False)
+    value = Column(Double)
+    text_value = Column(Text)
+
+    def __repr__(self):
+        return f"<FdbkValue Rnd#{self.round_id} {self.key_name}:{self.path}>"
+
+    @staticmethod
+    def finite_float(leaf) -> float | None:
+        """
+        `leaf` as a float, or None if it isn't a number or is NaN or infinite,
+        e.g. a name such as "Nan" in associative feedback. MySQL's DOUBLE
+        can't hold those, and inserting one would fail the whole round.
+        """
+        try:
+            value = float(leaf)
+        except (ValueError, OverflowError):
+            return None
+        return value if math.isfinite(value) else None
+
+    @staticmethod
+    def rows(fb: Feedback) -> list[dict]:
+        """Insertable rows for the leaves of `fb`, if it is of a normalized type."""
+        if fb.key_type not in FeedbackValue.NORMALIZED_KEY_TYPES:
+            return []
+
+        rows = list()
+        for path, leaf in feedback_leaves(fb.json_data()):
+            value = text_value = None
+            if isinstance(leaf, (int, float)):
+                value = FeedbackValue.finite_float(leaf)
+            elif isinstance(leaf, str):
+                text_value = leaf
+                value = FeedbackValue.finite_float(leaf)
+            elif leaf is not None:
+                text_value = json.dumps(leaf)
+            rows.append(
+                {
+                    "round_id": fb.round_id,
+                    "key_name": fb.key_name,
+                    "path": path[:255],
+                    "value": value,
+                    "text_value": text_value,
+                }
+            )
+        return rows
+
+
 class LegacyPopulation(Base):
     __tablename__ = "legacy_population"
+    # Serves both lookups by round and finding the unlinked samples in a
+    # round's time window.
+    __table_args__ = (Index("ix_legacy_population_round_id_time", "round_id", "time"),)
 
     id = Column(INTEGER(11), primary_key=True)
     playercount = Column(INTEGER(11))
     admincount = Column(INTEGER(11))
     server_id = Column(String(50))
     time = Column(DateTime, nullable=False)
-    round = relationship(
-        "Round",
-        primaryjoin="and_(LegacyPopulation.time>=foreign(Round.initialize_datetime), LegacyPopulation.time<=foreign(Round.shutdown_datetime))",
-        back_populates="populations",
-        viewonly=True,
-        uselist=False,
-    )
+    # Set at ingest; rows from before that can be filled in with
+    # `backfill_population_rounds`.
+    round_id: Mapped[Optional[int]] = mapped_column(ForeignKey("round.id"))
+
+    round: Mapped[Optional["Round"]] = relationship(back_populates="populations")
 
     def __str__(self):
         return f"<Players {self.playercount: >3}@{self.time.strftime('%Y-%m-%d %H:%M:%S')}>"
@@ -121,18 +271,56 @@ class LegacyPopulation(Base):
         return self.__str__()
 
 
+class PopulationSeries:
+    """
+    A round's population samples sorted by time, with the sample times and
+    player counts held in NumPy arrays so lookups are binary searches.
+    """
+
+    def __init__(self, populations: Iterable[LegacyPopulation]):
+        populations = list(populations)
+        times = np.array([x.time for x in populations], dtype="datetime64[us]")
+        order = np.argsort(times, kind="stable")
+        self.times = times[order]
+        self.counts = np.array(
+            [populations[i].playercount or 0 for i in order], dtype=np.int32
+        )
+        self.samples = [populations[i] for i in order]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def first(self) -> LegacyPopulation | None:
+        return self.samples[0] if self.samples else None
+
+    def last(self) -> LegacyPopulation | None:
+        return self.samples[-1] if self.samples else None
+
+    def first_at_or_after(self, when) -> LegacyPopulation | None:
+        i = np.searchsorted(self.times, np.datetime64(when, "us"), side="left")
+        return self.samples[i] if i < len(self.samples) else None
+
+    def last_at_or_before(self, when) -> LegacyPopulation | None:
+        i = np.searchsorted(self.times, np.datetime64(when, "us"), side="right") - 1
+        return self.samples[i] if i >= 0 else None
+
+
 class Library(Base):
     __tablename__ = "library"
 
     id = Column(INTEGER(11), primary_key=True)
-    author = Column(MEDIUMTEXT, nullable=False)
-    title = Column(MEDIUMTEXT, nullable=False)
-    content = Column(MEDIUMTEXT, nullable=False)
-    ckey = Column(String(32, "utf8mb4_unicode_ci"), nullable=False, index=True)
-    reports = Column(MEDIUMTEXT, nullable=False, index=True)
-    summary = Column(MEDIUMTEXT, nullable=False)
+    author = Column(MediumText, nullable=False)
+    title = Column(MediumText, nullable=False)
+    content = Column(MediumText, nullable=False)
+    ckey = Column(
+        String(32).with_variant(String(32, "utf8mb4_unicode_ci"), *MYSQL_DIALECTS),
+        nullable=False,
+        index=True,
+    )
+    reports = Column(MediumText, nullable=False, index=True)
+    summary = Column(MediumText, nullable=False)
     rating = Column(Float(asdecimal=True), server_default=text("0"))
-    raters = Column(MEDIUMTEXT, nullable=False)
+    raters = Column(MediumText, nullable=False)
     primary_category = Column(INTEGER(11), server_default=text("0"))
     secondary_category = Column(INTEGER(11), nullable=False, server_default=text("0"))
     tertiary_category = Column(INTEGER(11), server_default=text("0"))
@@ -140,10 +328,17 @@ class Library(Base):
 
 class Round(Base):
     __tablename__ = "round"
+    __table_args__ = (
+        Index(
+            "ix_round_initialize_datetime_shutdown_datetime",
+            "initialize_datetime",
+            "shutdown_datetime",
+        ),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     initialize_datetime = Column(DateTime, nullable=False)
-    start_datetime = Column(DateTime)
+    start_datetime = Column(DateTime, index=True)
     shutdown_datetime = Column(DateTime)
     end_datetime = Column(DateTime)
     server_ip = Column(INTEGER(10), nullable=False)
@@ -157,15 +352,21 @@ class Round(Base):
     station_name = Column(String(80))
     server_id = Column(String(50))
 
+    # Loaded with a second SELECT ... WHERE round_id IN (...) by default, so
+    # a query for many rounds doesn't repeat every round's columns for each of
+    # its feedback rows. Use `feedback_loader` to pick something else. Ordered
+    # by id so the first of any duplicate keys is the oldest row. Rounds
+    # without feedback are loaded with an empty list; the inner joined load
+    # this replaced left them out of every query, and `session.get` returned
+    # None for them.
     feedbacks: Mapped[List["Feedback"]] = relationship(
-        back_populates="round", innerjoin=True, lazy="joined"
+        back_populates="round", lazy="selectin", order_by="Feedback.id"
     )
     populations: Mapped[List["LegacyPopulation"]] = relationship(
-        "LegacyPopulation",
-        primaryjoin="and_(LegacyPopulation.time>=Round.initialize_datetime, LegacyPopulation.time<=Round.shutdown_datetime)",
-        foreign_keys=[initialize_datetime, shutdown_datetime],
-        viewonly=True,
-        uselist=True,
+        back_populates="round"
+    )
+    testmerges: Mapped[List["RoundTestmerge"]] = relationship(
+        back_populates="round"
     )
 
     def __repr__(self):
@@ -173,7 +374,11 @@ class Round(Base):
 
     @staticmethod
     def download(
-        engine: Engine, round_id: str, rq_session: CachedLimiterSession, api_url: str
+        engine: Engine,
+        round_id: str,
+        rq_session: CachedLimiterSession,
+        api_url: str,
+        compress_threshold: int | None = None,
     ) -> Optional["Round"]:
         with Session(engine, expire_on_commit=False) as session:
             if session.get(Round, round_id):
@@ -185,10 +390,10 @@ class Round(Base):
 
             rnd = Round(
                 id=mtd["round_id"],
-                initialize_datetime=mtd["init_datetime"],
-                start_datetime=mtd["start_datetime"],
-                shutdown_datetime=mtd["shutdown_datetime"],
-                end_datetime=mtd["end_datetime"],
+                initialize_datetime=parse_api_datetime(mtd["init_datetime"]),
+                start_datetime=parse_api_datetime(mtd["start_datetime"]),
+                shutdown_datetime=parse_api_datetime(mtd["shutdown_datetime"]),
+                end_datetime=parse_api_datetime(mtd["end_datetime"]),
                 commit_hash=mtd["commit_hash"],
                 game_mode=mtd["game_mode"],
                 game_mode_result=mtd["game_mode_result"],
@@ -201,77 +406,97 @@ class Round(Base):
             pcts = list()
             for dt, ct in pct.items():
                 lp = LegacyPopulation(
-                    playercount=ct, admincount=0, server_id=mtd["server_id"], time=dt
+                    round_id=mtd["round_id"],
+                    playercount=ct,
+                    admincount=0,
+                    server_id=mtd["server_id"],
+                    time=parse_api_datetime(dt),
                 )
                 pcts.append(lp)
             data = list()
             for row in bbl:
-                fb = Feedback(
+                fb = Feedback.from_raw(
+                    row["raw_data"],
+                    compress_threshold,
                     round_id=mtd["round_id"],
                     key_name=row["key_name"],
                     key_type=row["key_type"],
                     version=row["version"],
-                    json=json.loads(row["raw_data"]),
-                    datetime=mtd["init_datetime"],
+                    datetime=rnd.initialize_datetime,
                 )
                 data.append(fb)
 
             session.add_all([rnd] + pcts + data)
+            session.flush()
+            # Reload what was just inserted so derived tables are computed from
+            # the stored rows, with the round's relationships populated.
+            session.expire_all()
+            add_derived_rows(session, rnd)
             session.commit()
 
             return rnd
 
+    def _collection_cache(self, name: str, collection, build):
+        """
+        Cache `build(collection)` on the instance until `collection` is
+        replaced (e.g. by a reload) or changes size.
+        """
+        cached = self.__dict__.get(name)
+        if cached is None or cached[0] is not collection or cached[1] != len(collection):
+            cached = (collection, len(collection), build(collection))
+            self.__dict__[name] = cached
+        return cached[2]
+
+    @property
+    def feedback_index(self) -> dict[str, Feedback]:
+        """
+        `key_name` -> `Feedback` mapping for the loaded feedbacks. If a key
+        was sent more than once, e.g. under two versions, the row with the
+        lowest id wins, as in `feedback_by_round`.
+        """
+        # Reversed so the first of any duplicate keys wins
+        return self._collection_cache(
+            "_feedback_index",
+            self.feedbacks,
+            lambda feedbacks: {x.key_name: x for x in reversed(feedbacks)},
+        )
+
+    @property
+    def population_series(self) -> "PopulationSeries":
+        """The round's population samples as a sorted time series."""
+        return self._collection_cache(
+            "_population_series", self.populations, PopulationSeries
+        )
+
     def feedback(self, k) -> Feedback | None:
-        for x in self.feedbacks:
-            if x.key_name == k:
-                return x
+        return self.feedback_index.get(k)
 
     def has_feedback(self, name) -> bool:
-        return any(x.key_name == name for x in self.feedbacks)
+        return name in self.feedback_index
 
     @property
     def serverstart_population(self):
-        if not self.populations:
-            return None
-        return sorted(self.populations, key=lambda x: x.time)[0]
+        return self.population_series.first()
 
     @property
     def serverstop_population(self):
-        if not self.populations:
-            return None
-        return sorted(self.populations, key=lambda x: x.time, reverse=True)[0]
+        return self.population_series.last()
 
     @property
     def roundstart_population(self):
-        if not self.populations:
-            return None
         if not self.start_datetime:
-            return sorted([x for x in self.populations], key=lambda x: x.time)[0]
-
-        pops = sorted(
-            [x for x in self.populations if x.time >= self.start_datetime],
-            key=lambda x: x.time,
-        )
-        if pops:
-            return pops[0]
+            return self.population_series.first()
+        return self.population_series.first_at_or_after(self.start_datetime)
 
     @property
     def roundend_population(self):
-        if not self.populations:
-            return None
         if not self.end_datetime:
-            return sorted([x for x in self.populations], key=lambda x: x.time)[-1]
-
-        pops = sorted(
-            [x for x in self.populations if x.time <= self.end_datetime],
-            key=lambda x: x.time,
-        )
-        if pops:
-            return pops[-1]
+            return self.population_series.last()
+        return self.population_series.last_at_or_before(self.end_datetime)
 
     @property
     def highest_player_count(self) -> int:
-        return max(p.playercount for p in self.populations)
+        return int(self.population_series.counts.max())
 
     def roundstart_job_count(self, with_assts=False) -> int:
         if with_assts:
@@ -312,21 +537,15 @@ class Round(Base):
         return self.feedback("job_preferences")["Assistant"]["never"]
 
     def has_testmerge(self, pr_id):
-        if self.has_feedback("testmerged_prs"):
-            tprs = self.feedback("testmerged_prs")
-            for pr in tprs.values():
-                if pr["number"] == str(pr_id):
-                    return True
-
-        return False
+        return any(tm.pr_number == int(pr_id) for tm in self.testmerges)
 
     @property
     def roundstart_client_count(self):
-        return sorted(self.populations, key=lambda x: x.time)[0].playercount
+        return int(self.population_series.counts[0])
 
     @property
     def highest_player_count(self):
-        return max(p.playercount for p in self.populations)
+        return int(self.population_series.counts.max())
 
     def roundstart_job_count(self, with_assts=False) -> int:
         manifest = self.feedback("manifest")
@@ -340,8 +559,139 @@ class Round(Base):
         )
 
 
+class RoundSummary(Base):
+    """
+    Per-round values that are otherwise recomputed from feedback and
+    population samples, filled in at ingest time. Rounds downloaded before
+    this table existed can be caught up with `update_round_summaries`.
+    """
+
+    __tablename__ = "round_summary"
+
+    round_id: Mapped[int] = mapped_column(ForeignKey("round.id"), primary_key=True)
+    start_datetime = Column(DateTime, index=True)
+    end_datetime = Column(DateTime)
+    map_name = Column(String(32), index=True)
+    game_mode = Column(String(32), index=True)
+    end_state = Column(String(64))
+    duration_seconds = Column(INTEGER(11))
+    serverstart_player_count = Column(INTEGER(11))
+    roundstart_player_count = Column(INTEGER(11))
+    roundend_player_count = Column(INTEGER(11))
+    highest_player_count = Column(INTEGER(11))
+    roundstart_job_count = Column(INTEGER(11))
+    roundstart_job_count_with_assts = Column(INTEGER(11))
+    manifest_roundstart_total = Column(INTEGER(11))
+    manifest_latejoin_total = Column(INTEGER(11))
+
+    def __repr__(self):
+        return f"<RoundSummary#{self.round_id} {self.game_mode}/{self.map_name}>"
+
+    @staticmethod
+    def from_round(rnd: Round) -> "RoundSummary":
+        def playercount(population):
+            return population.playercount if population else None
+
+        duration = None
+        if rnd.start_datetime and rnd.end_datetime:
+            duration = int((rnd.end_datetime - rnd.start_datetime).total_seconds())
+
+        return RoundSummary(
+            round_id=rnd.id,
+            start_datetime=rnd.start_datetime,
+            end_datetime=rnd.end_datetime,
+            map_name=rnd.map_name,
+            game_mode=rnd.game_mode,
+            end_state=rnd.end_state,
+            duration_seconds=duration,
+            serverstart_player_count=playercount(rnd.serverstart_population),
+            roundstart_player_count=playercount(rnd.roundstart_population),
+            roundend_player_count=playercount(rnd.roundend_population),
+            highest_player_count=rnd.highest_player_count if rnd.populations else None,
+            roundstart_job_count=rnd.roundstart_job_count(),
+            roundstart_job_count_with_assts=rnd.roundstart_job_count(with_assts=True),
+            manifest_roundstart_total=rnd.manifest_total(roundstart=True),
+            manifest_latejoin_total=rnd.manifest_total(latejoin=True),
+        )
+
+
+class RoundTestmerge(Base):
+    """
+    One PR testmerged in a round, taken from its `testmerged_prs` feedback at
+    ingest, so rounds can be looked up by PR with an indexed query. Rounds
+    downloaded before this table existed can be caught up with
+    `update_round_testmerges`.
+    """
+
+    __tablename__ = "round_testmerge"
+    __table_args__ = (
+        Index("ix_round_testmerge_pr_number_round_id", "pr_number", "round_id"),
+    )
+
+    id = Column(INTEGER(11), primary_key=True)
+    round_id: Mapped[int] = mapped_column(ForeignKey("round.id"), index=True)
+    pr_number = Column(INTEGER(11), nullable=False)
+    commit = Column(String(40))
+    title = Column(String(255))
+
+    round: Mapped["Round"] = relationship(back_populates="testmerges")
+
+    def __repr__(self):
+        return f"<Testmerge Rnd#{self.round_id} PR#{self.pr_number}>"
+
+    @staticmethod
+    def rows(fb: Feedback) -> list[dict]:
+        """Insertable rows for the PRs in a `testmerged_prs` feedback."""
+        if fb.key_name != "testmerged_prs":
+            return []
+
+        rows = list()
+        for pr in fb.values():
+            try:
+                pr_number = int(pr["number"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            commit = pr.get("commit")
+            title = pr.get("title")
+            rows.append(
+                {
+                    "round_id": fb.round_id,
+                    "pr_number": pr_number,
+                    "commit": commit[:40] if commit else None,
+                    "title": title[:255] if title else None,
+                }
+            )
+        return rows
+
+
+class RoundBackfill(Base):
+    """
+    A round whose feedback a backfill tool has already turned into rows of
+    the derived table `table_name`, even if it produced none, so rounds with
+    e.g. empty tallies aren't picked up again on every run.
+    """
+
+    __tablename__ = "round_backfill"
+
+    round_id: Mapped[int] = mapped_column(ForeignKey("round.id"), primary_key=True)
+    table_name = Column(String(64), primary_key=True)
+
+    def __repr__(self):
+        return f"<RoundBackfill Rnd#{self.round_id} {self.table_name}>"
+
+
 class ProfilerSample(Base):
     __tablename__ = "profiler_sample"
+    # Also serves lookups by (round_id, proc_path).
+    __table_args__ = (
+        Index(
+            "ux_profiler_sample_round_id_proc_path_sample_time",
+            "round_id",
+            "proc_path",
+            "sample_time",
+            unique=True,
+        ),
+    )
 
     id = Column(INTEGER(11), primary_key=True)
     round_id: Mapped[int] = mapped_column(ForeignKey("round.id"))
@@ -352,3 +702,140 @@ class ProfilerSample(Base):
     real_time = Column(Double)
     overtime = Column(Double)
     proc_calls = Column(INTEGER(11))
+
+    METRICS = ("self_cpu", "total_cpu", "real_time", "overtime", "proc_calls")
+
+
+class ProfilerRollupMixin:
+    """Summary statistics of one profiler metric over a set of samples of a proc."""
+
+    proc_path = Column(String(300), primary_key=True)
+    metric = Column(String(16), primary_key=True)
+    sample_count = Column(INTEGER(11), nullable=False)
+    value_sum = Column(Double)
+    value_min = Column(Double)
+    value_max = Column(Double)
+    p50 = Column(Double)
+    p95 = Column(Double)
+
+
+class ProfilerRoundRollup(ProfilerRollupMixin, Base):
+    """
+    Profiler statistics per round, proc and metric, kept by
+    `update_profiler_rollups` so they outlive pruned raw samples.
+    """
+
+    __tablename__ = "profiler_round_rollup"
+
+    round_id: Mapped[int] = mapped_column(ForeignKey("round.id"), primary_key=True)
+
+    def __repr__(self):
+        return f"<ProfilerRoundRollup Rnd#{self.round_id} {self.proc_path}:{self.metric}>"
+
+
+class ProfilerDailyRollup(ProfilerRollupMixin, Base):
+    """Profiler statistics per day of sample time, proc and metric."""
+
+    __tablename__ = "profiler_daily_rollup"
+
+    day = Column(Date, primary_key=True)
+
+    def __repr__(self):
+        return f"<ProfilerDailyRollup {self.day} {self.proc_path}:{self.metric}>"
+
+
+def add_derived_rows(session: Session, rnd: Round):
+    """Add the rows of the tables derived from a newly ingested round."""
+    session.add(RoundSummary.from_round(rnd))
+    values = [row for fb in rnd.feedbacks for row in FeedbackValue.rows(fb)]
+    if values:
+        session.execute(insert(FeedbackValue), values)
+    testmerges = [row for fb in rnd.feedbacks for row in RoundTestmerge.rows(fb)]
+    if testmerges:
+        session.execute(insert(RoundTestmerge), testmerges)
+
+
+def insert_ignoring_duplicates(session: Session, entity, rows: list[dict]):
+    """
+    Bulk insert `rows` into the table of `entity`, skipping rows that collide
+    with an existing row on a unique key.
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect in MYSQL_DIALECTS:
+        stmt = mysql_insert(entity)
+        # Assigning the primary key to itself turns a duplicate into a no-op
+        pk = stmt.table.primary_key.columns[0]
+        stmt = stmt.on_duplicate_key_update({pk.name: pk})
+    elif dialect == "sqlite":
+        stmt = sqlite_insert(entity).on_conflict_do_nothing()
+    else:
+        raise ValueError(f"unsupported database {dialect}")
+    session.execute(stmt, rows)
+
+
+def feedback_loader(strategy: str = "selectin", keys: Iterable[str] | None = None):
+    """
+    Loader option for `Round.feedbacks`.
+
+    `strategy` is one of `selectin`, `joined` or `noload`. If `keys` is given,
+    only feedback with those `key_name`s is loaded, so e.g. `Round.feedback`
+    and `Round.has_feedback` only see those keys.
+    """
+    if strategy == "noload":
+        return noload(Round.feedbacks)
+    loaders = {"selectin": selectinload, "joined": joinedload}
+    if strategy not in loaders:
+        raise ValueError(f"unknown feedback loading strategy {strategy}")
+
+    attr = Round.feedbacks
+    if keys is not None:
+        attr = attr.and_(Feedback.key_name.in_(list(keys)))
+    return loaders[strategy](attr)
+
+
+def select_rounds(
+    strategy: str = "selectin",
+    keys: Iterable[str] | None = None,
+    populations: bool = False,
+) -> Select:
+    """
+    `select(Round)` with the given feedback loading strategy. Rounds without
+    any matching feedback are included, with empty `feedbacks`. Rounds
+    already in the session are refreshed, so a key-filtered load replaces
+    any feedback loaded before. If `populations` is set, population samples
+    are loaded up front too, in one extra query for all rounds.
+    """
+    options = [feedback_loader(strategy, keys)]
+    if populations:
+        options.append(selectinload(Round.populations))
+    return (
+        select(Round)
+        .options(*options)
+        .execution_options(populate_existing=True)
+    )
+
+
+def feedback_by_round(
+    session: Session, round_ids: Iterable[int], keys: Iterable[str], chunk_size=1000
+) -> dict[int, dict[str, Feedback]]:
+    """
+    Fetch the feedback with the given `key_name`s for many rounds at once,
+    as `round_id` -> `key_name` -> `Feedback`. Rounds with none of the keys
+    are left out. If a key was sent more than once, the row with the lowest
+    id wins, as in `Round.feedback_index`.
+    """
+    round_ids = list(round_ids)
+    keys = list(keys)
+    result: dict[int, dict[str, Feedback]] = dict()
+    for i in range(0, len(round_ids), chunk_size):
+        query = (
+            select(Feedback)
+            .where(
+                Feedback.round_id.in_(round_ids[i : i + chunk_size]),
+                Feedback.key_name.in_(keys),
+            )
+            .order_by(Feedback.id)
+        )
+        for fb in session.scalars(query):
+            result.setdefault(fb.round_id, dict()).setdefault(fb.key_name, fb)
+    return result
@@ -1,26 +1,397 @@
+from dataclasses import dataclass
+from datetime import timedelta
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+import sqlite3
+import threading
+import time
+from typing import TYPE_CHECKING, Iterable
+from urllib.parse import urlparse
 
-from requests import Session
+from requests import PreparedRequest, Response, Session
 from requests_cache import CacheMixin
-from requests_ratelimiter import LimiterMixin, SQLiteBucket
 
+if TYPE_CHECKING:
+    MIXIN_BASE = Session
+else:
+    MIXIN_BASE = object
 
-class CachedLimiterSession(CacheMixin, LimiterMixin, Session):
+# Listing endpoints that change over time. Once these expire they are
+# revalidated with If-None-Match/If-Modified-Since instead of being downloaded
+# again. Revalidation happens before the response is returned rather than in
+# the background, since the cron jobs act once on whatever list they get and
+# a stale one would make them miss new rounds until the next run.
+REVALIDATED_URLS = {
+    "*/stats/roundlist": timedelta(hours=1),
+    "*/profiler/getproc": timedelta(hours=1),
+}
+
+# Rate-limit reset headers are either delta-seconds or an epoch timestamp.
+# No rate window lasts anywhere near this long (about 31 years), so anything
+# larger is taken to be a timestamp.
+RESET_EPOCH_THRESHOLD = 1e9
+
+
+@dataclass(frozen=True)
+class BucketState:
+    """A snapshot of one rate of a shared token bucket."""
+
+    name: str
+    capacity: int
+    interval: float
+    tokens: float
+    paused_until: float
+
+    @property
+    def paused_for(self) -> float:
+        return max(0.0, self.paused_until - time.time())
+
+
+class SharedTokenBucket:
+    """
+    Token bucket whose state lives in a small SQLite database, so that several
+    processes (e.g. `sync_blackbox` and `update_profilesamples` running from
+    cron) draw from one shared request budget.
+
+    Each rate is a single row holding its remaining tokens and the time it was
+    last refilled. Acquiring a token is one short `BEGIN IMMEDIATE` transaction
+    in WAL mode, so readers are never blocked and writers only hold the lock for
+    a handful of statements instead of for the whole request.
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        rates: Iterable[tuple[int, float]],
+        busy_timeout: float = 30.0,
+    ):
+        self.path = Path(path)
+        self.rates = tuple((int(limit), float(interval)) for limit, interval in rates)
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                str(self.path), timeout=self.busy_timeout, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS token_bucket ("
+                " name TEXT NOT NULL,"
+                " interval REAL NOT NULL,"
+                " capacity INTEGER NOT NULL,"
+                " tokens REAL NOT NULL,"
+                " updated REAL NOT NULL,"
+                " paused_until REAL NOT NULL DEFAULT 0,"
+                " PRIMARY KEY (name, interval))"
+            )
+            self._local.connection = conn
+        return conn
+
+    def _refilled_rows(self, name: str, now: float):
+        """
+        Return the refilled `(interval, capacity, tokens, paused_until)` rows
+        for `name`, creating them at full capacity on first use. Must be called
+        inside a transaction.
+        """
+        conn = self.connection
+        rows = {
+            interval: (capacity, tokens, updated, paused_until)
+            for interval, capacity, tokens, updated, paused_until in conn.execute(
+                "SELECT interval, capacity, tokens, updated, paused_until"
+                " FROM token_bucket WHERE name = ?",
+                (name,),
+            )
+        }
+        result = []
+        for capacity, interval in self.rates:
+            if interval not in rows:
+                conn.execute(
+                    "INSERT INTO token_bucket (name, interval, capacity, tokens, updated)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (name, interval, capacity, capacity, now),
+                )
+                result.append((interval, capacity, float(capacity), 0.0))
+                continue
+            _, tokens, updated, paused_until = rows[interval]
+            refill = max(0.0, now - updated) * capacity / interval
+            result.append(
+                (interval, capacity, min(float(capacity), tokens + refill), paused_until)
+            )
+        return result
+
+    def _store(self, name: str, rows, now: float):
+        self.connection.executemany(
+            "UPDATE token_bucket SET tokens = ?, updated = ?, paused_until = ?"
+            " WHERE name = ? AND interval = ?",
+            [
+                (tokens, now, paused_until, name, interval)
+                for interval, _, tokens, paused_until in rows
+            ],
+        )
+
+    def _transaction(self, name: str, fn):
+        conn = self.connection
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            rows = self._refilled_rows(name, now)
+            rows, result = fn(rows, now)
+            self._store(name, rows, now)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def _take(self, name: str) -> tuple[float, dict[float, float]]:
+        """
+        Take one token from every rate of `name`. Returns 0 and the tokens
+        left per rate interval on success, or the number of seconds to wait
+        before a token will be available.
+        """
+
+        def take(rows, now):
+            wait = 0.0
+            for interval, capacity, tokens, paused_until in rows:
+                wait = max(wait, paused_until - now)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) * interval / capacity)
+            if wait > 0:
+                return rows, (wait, {})
+            rows = [
+                (interval, capacity, tokens - 1, paused_until)
+                for interval, capacity, tokens, paused_until in rows
+            ]
+            return rows, (0.0, {interval: tokens for interval, _, tokens, _ in rows})
+
+        return self._transaction(name, take)
+
+    def try_acquire(self, name: str) -> float:
+        """
+        Take one token from every rate of `name`. Returns 0 on success, or the
+        number of seconds to wait before a token will be available.
+        """
+        return self._take(name)[0]
+
+    def acquire(self, name: str, max_delay: float | None = None) -> dict[float, float]:
+        """
+        Block until a token for `name` is available. Returns the tokens left
+        afterwards per rate interval.
+        """
+        while True:
+            wait, tokens = self._take(name)
+            if wait <= 0:
+                return tokens
+            if max_delay is not None and wait > max_delay:
+                raise RuntimeError(
+                    f"rate limit for {name} requires waiting {wait:.1f}s (max_delay={max_delay})"
+                )
+            time.sleep(wait)
+
+    def adjust(
+        self,
+        name: str,
+        refund: bool = False,
+        remaining: float | None = None,
+        interval: float | None = None,
+        pause: float | None = None,
+    ):
+        """
+        Settle a request in one transaction: give back its token if it didn't
+        use up any budget, clamp the rate with `interval` (or every rate) to at
+        most `remaining` tokens as reported by the server, and/or stop handing
+        out tokens for `pause` seconds.
+        """
+
+        def settle(rows, now):
+            adjusted = []
+            for rate_interval, capacity, tokens, paused_until in rows:
+                if refund:
+                    tokens = min(float(capacity), tokens + 1)
+                if remaining is not None and interval in (None, rate_interval):
+                    tokens = min(tokens, float(remaining))
+                if pause is not None:
+                    paused_until = max(paused_until, now + pause)
+                adjusted.append((rate_interval, capacity, tokens, paused_until))
+            return adjusted, None
+
+        self._transaction(name, settle)
+
+    def refund(self, name: str):
+        """Give back a token taken for a request that didn't use up any budget."""
+        self.adjust(name, refund=True)
+
+    def throttle(
+        self,
+        name: str,
+        remaining: float | None = None,
+        pause: float | None = None,
+        interval: float | None = None,
+    ):
+        """
+        Adjust the bucket to what the server reported: clamp the rate with
+        `interval` (or every rate) to at most `remaining` tokens, and/or stop
+        handing out tokens for `pause` seconds.
+        """
+        self.adjust(name, remaining=remaining, interval=interval, pause=pause)
+
+    def state(self, name: str | None = None) -> list[BucketState]:
+        """Current token state of every bucket (or just `name`), for monitoring."""
+        query = "SELECT name, capacity, interval, tokens, updated, paused_until FROM token_bucket"
+        params = ()
+        if name is not None:
+            query += " WHERE name = ?"
+            params = (name,)
+        now = time.time()
+        states = []
+        for name, capacity, interval, tokens, updated, paused_until in self.connection.execute(
+            query + " ORDER BY name, interval", params
+        ):
+            refill = max(0.0, now - updated) * capacity / interval
+            states.append(
+                BucketState(
+                    name=name,
+                    capacity=capacity,
+                    interval=interval,
+                    tokens=min(float(capacity), tokens + refill),
+                    paused_until=paused_until,
+                )
+            )
+        return states
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parse a `Retry-After` header, given either in seconds or as an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _header(response: Response, *names: str) -> str | None:
+    for name in names:
+        if name in response.headers:
+            return response.headers[name]
+
+
+class AdaptiveLimiterMixin(MIXIN_BASE):
+    """
+    Mixin class that rate-limits requests through a `SharedTokenBucket`, and
+    slows down when the server reports its own limits via `Retry-After` or
+    rate-limit headers.
+
+    Responses with a status in `free_statuses` (by default 304 Not Modified
+    answers to conditional requests) give their token back, so revalidating
+    an unchanged list doesn't eat into our own budget. If the server does
+    count them, its rate-limit headers will still pull us back in line.
+    """
+
+    def __init__(
+        self,
+        bucket_path: str | Path,
+        per_minute: int = 0,
+        per_hour: int = 0,
+        max_delay: float | None = None,
+        limit_statuses: Iterable[int] = (429,),
+        free_statuses: Iterable[int] = (304,),
+        **kwargs,
+    ):
+        rates = [(per_minute, 60.0), (per_hour, 3600.0)]
+        self.bucket = SharedTokenBucket(
+            bucket_path, [(limit, interval) for limit, interval in rates if limit]
+        )
+        self.max_delay = max_delay
+        self.limit_statuses = tuple(limit_statuses)
+        self.free_statuses = tuple(free_statuses)
+        super().__init__(**kwargs)
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        name = urlparse(request.url).netloc
+        tokens = self.bucket.acquire(name, max_delay=self.max_delay)
+        response = super().send(request, **kwargs)
+
+        refund = response.status_code in self.free_statuses
+        remaining, interval, pause = self._server_limits(response)
+        if remaining is not None and remaining >= tokens.get(interval, float("inf")):
+            # Our own count is already at least as strict as the server's.
+            remaining = None
+        if refund or remaining is not None or pause is not None:
+            self.bucket.adjust(
+                name, refund=refund, remaining=remaining, interval=interval, pause=pause
+            )
+        return response
+
+    def _window(self, reset: float | None) -> float:
+        """
+        The interval of the rate that a server limit resetting in `reset`
+        seconds corresponds to: the shortest rate whose window is at least
+        that long, or the shortest rate if the reset time isn't known.
+        """
+        intervals = sorted(interval for _, interval in self.bucket.rates)
+        if reset is not None:
+            for interval in intervals:
+                if interval >= reset:
+                    return interval
+            return intervals[-1]
+        return intervals[0]
+
+    def _server_limits(
+        self, response: Response
+    ) -> tuple[float | None, float | None, float | None]:
+        """
+        The tokens the server says are left, the interval of the rate they
+        apply to, and how long to pause for, from its response headers.
+        """
+        pause = parse_retry_after(response.headers.get("Retry-After"))
+        remaining = _header(response, "X-RateLimit-Remaining", "RateLimit-Remaining")
+        reset = _header(response, "X-RateLimit-Reset", "RateLimit-Reset")
+        try:
+            remaining = float(remaining) if remaining is not None else None
+            reset = float(reset) if reset is not None else None
+        except ValueError:
+            remaining = reset = None
+
+        if reset is not None and reset > RESET_EPOCH_THRESHOLD:
+            reset = max(0.0, reset - time.time())
+        if remaining is not None and remaining <= 0 and reset is not None:
+            pause = max(pause or 0.0, reset)
+        if response.status_code in self.limit_statuses and pause is None:
+            # We've gotten out of sync with the server but it didn't say by how
+            # much; empty the bucket so we wait for a refill.
+            remaining = 0
+        if not self.bucket.rates:
+            return None, None, pause
+        return remaining, self._window(reset), pause
+
+    def limiter_state(self) -> list[BucketState]:
+        return self.bucket.state()
+
+
+class CachedLimiterSession(CacheMixin, AdaptiveLimiterMixin, Session):
     """
     Session class with caching and rate-limiting behavior. Accepts arguments for both
-    LimiterSession and CachedSession.
+    CachedSession and AdaptiveLimiterMixin. Cached responses never reach the
+    limiter, so they don't use up any of the request budget.
     """
 
 
 def make_cached_limiter_session(cache_db: str | Path):
+    cache_db = Path(cache_db)
     return CachedLimiterSession(
+        cache_name=cache_db,
+        urls_expire_after=REVALIDATED_URLS,
+        bucket_path=cache_db.with_suffix(".ratelimit" + cache_db.suffix),
         per_minute=500,
         per_hour=3600,
-        cache_name=cache_db,
-        bucket_class=SQLiteBucket,
-        bucket_kwargs={
-            "path": cache_db,
-            "isolation_level": "EXCLUSIVE",
-            "check_same_thread": False,
-        },
     )
@@ -1,7 +1,7 @@
 from pathlib import Path
 import urllib
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy import Engine
 import typed_settings as ts
 
@@ -15,6 +15,10 @@ class ParalysisSettings:
     profile_proc_paths: list[str]
     cache_db: Path
     connection_string: str = ts.secret()
+    # Feedback payloads at least this many bytes long are stored compressed.
+    feedback_compress_threshold: int | None = None
+    # Rolled up raw profiler samples older than this many days are deleted.
+    profile_retention_days: int | None = None
 
     def parastats(self, endpoint, **kwargs):
         return self.api_url + endpoint + '?' + urllib.parse.urlencode(kwargs)
@@ -23,4 +27,23 @@ def make_engine(config_file: str | Path) -> Engine:
     settings = ts.load(
         ParalysisSettings, appname="paralysis", config_files=[config_file]
     )
-    return create_engine(settings.connection_string)
+    return create_database_engine(settings.connection_string)
+
+
+def create_database_engine(connection_string: str) -> Engine:
+    """
+    `create_engine`, with local SQLite databases set up for analysis: WAL so
+    readers don't block ingest, and foreign keys enforced like on MySQL.
+    """
+    engine = create_engine(connection_string)
+    if engine.dialect.name == "sqlite":
+
+        @event.listens_for(engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute("PRAGMA foreign_keys=ON")
+            cursor.close()
+
+    return engine
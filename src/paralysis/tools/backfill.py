@@ -0,0 +1,71 @@
+from typing import Callable
+
+from loguru import logger
+from sqlalchemy import ColumnElement, Engine, delete, exists, insert, select
+from sqlalchemy.orm import Session
+
+from paralysis.model import Feedback, RoundBackfill
+
+
+def backfill_derived_rows(
+    engine: Engine,
+    entity,
+    source: ColumnElement[bool],
+    rows: Callable[[Feedback], list[dict]],
+    rebuild: bool = False,
+    batch_size: int = 500,
+) -> int:
+    """
+    Insert the rows of the table of `entity` derived with `rows` from each
+    feedback matching `source`, for rounds that haven't been processed yet,
+    or for every round if `rebuild` is set. A round counts as processed if
+    it already has derived rows, e.g. from ingest, or is recorded in
+    `round_backfill`. Every round gets recorded there once it is processed.
+    Returns the number of rows written.
+    """
+    table_name = entity.__table__.name
+    written = 0
+    with Session(engine) as session:
+        if rebuild:
+            session.execute(delete(entity))
+            session.execute(
+                delete(RoundBackfill).where(RoundBackfill.table_name == table_name)
+            )
+            session.commit()
+
+        missing = (
+            select(Feedback.round_id)
+            .where(
+                source,
+                ~exists().where(entity.round_id == Feedback.round_id),
+                ~exists().where(
+                    RoundBackfill.round_id == Feedback.round_id,
+                    RoundBackfill.table_name == table_name,
+                ),
+            )
+            .distinct()
+            .order_by(Feedback.round_id)
+        )
+        round_ids = session.scalars(missing).all()
+
+        for i in range(0, len(round_ids), batch_size):
+            batch = round_ids[i : i + batch_size]
+            feedbacks = session.scalars(
+                select(Feedback).where(Feedback.round_id.in_(batch), source)
+            )
+            derived = [row for fb in feedbacks for row in rows(fb)]
+            if derived:
+                session.execute(insert(entity), derived)
+            session.execute(
+                insert(RoundBackfill),
+                [{"round_id": round_id, "table_name": table_name} for round_id in batch],
+            )
+            session.commit()
+            session.expunge_all()
+            written += len(derived)
+            logger.info(
+                f"{table_name}: processed {min(i + batch_size, len(round_ids))}/"
+                f"{len(round_ids)} rounds"
+            )
+
+    return written
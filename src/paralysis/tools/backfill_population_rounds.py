@@ -0,0 +1,68 @@
+import click
+from loguru import logger
+from sqlalchemy import Engine, bindparam, func, or_, select, update
+
+from paralysis.model import LegacyPopulation, Round
+from paralysis.settings import make_engine
+from paralysis.tools.migrate_schema import migrate_schema
+
+
+def backfill_population_rounds(engine: Engine, batch_size: int = 500) -> int:
+    """
+    Link population samples that have no `round_id` to the round on the same
+    server whose initialize/shutdown window contains them, going through the
+    rounds whose window overlaps any unlinked sample in batches of
+    `batch_size`. Where windows overlap, the lowest round id wins. Returns
+    the number of samples linked.
+    """
+    with engine.connect() as conn:
+        first, last = conn.execute(
+            select(func.min(LegacyPopulation.time), func.max(LegacyPopulation.time))
+            .where(LegacyPopulation.round_id.is_(None))
+        ).one()
+        if first is None:
+            return 0
+        rounds = conn.execute(
+            select(
+                Round.id.label("linked_round_id"),
+                Round.initialize_datetime.label("window_start"),
+                Round.shutdown_datetime.label("window_end"),
+                Round.server_id.label("round_server_id"),
+            )
+            .where(
+                Round.initialize_datetime <= last,
+                Round.shutdown_datetime >= first,
+            )
+            .order_by(Round.id)
+        ).mappings().all()
+
+    link = (
+        update(LegacyPopulation)
+        .where(
+            LegacyPopulation.round_id.is_(None),
+            LegacyPopulation.time >= bindparam("window_start"),
+            LegacyPopulation.time <= bindparam("window_end"),
+            or_(
+                LegacyPopulation.server_id.is_(None),
+                LegacyPopulation.server_id == bindparam("round_server_id"),
+            ),
+        )
+        .values(round_id=bindparam("linked_round_id"))
+    )
+    linked = 0
+    for i in range(0, len(rounds), batch_size):
+        with engine.begin() as conn:
+            for row in rounds[i : i + batch_size]:
+                linked += conn.execute(link, row).rowcount
+        logger.info(f"checked {min(i + batch_size, len(rounds))}/{len(rounds)} rounds")
+    return linked
+
+
+@click.command()
+@click.option("--settings", required=True, help="Location of your settings.toml file.")
+def main(settings):
+    engine = make_engine(settings)
+    migrate_schema(engine, tables=[LegacyPopulation.__table__, Round.__table__])
+    logger.info("linking population samples to rounds...")
+    linked = backfill_population_rounds(engine)
+    logger.info(f"linked {linked} population samples")
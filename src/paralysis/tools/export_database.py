@@ -0,0 +1,57 @@
+from pathlib import Path
+
+import click
+from loguru import logger
+from sqlalchemy import Engine, insert, inspect, select
+
+from paralysis.model import Base
+from paralysis.settings import create_database_engine, make_engine
+
+
+def export_database(source: Engine, target: Engine, batch_size: int = 10_000) -> dict:
+    """
+    Copy every table of the model from `source` into `target`, creating the
+    schema there first. Rows are streamed from `source` and inserted in
+    batches of `batch_size`. Columns the source database doesn't have yet are
+    left empty. Returns the number of rows copied per table.
+    """
+    Base.metadata.create_all(target)
+    source_inspector = inspect(source)
+    source_tables = set(source_inspector.get_table_names())
+
+    copied = dict()
+    with source.connect() as src:
+        src = src.execution_options(stream_results=True, yield_per=batch_size)
+        for table in Base.metadata.sorted_tables:
+            if table.name not in source_tables:
+                logger.info(f"skipping {table.name}, not in the source database")
+                continue
+
+            source_columns = {c["name"] for c in source_inspector.get_columns(table.name)}
+            columns = [c for c in table.columns if c.name in source_columns]
+            result = src.execute(select(*columns).order_by(*table.primary_key.columns))
+
+            copied[table.name] = 0
+            for partition in result.mappings().partitions():
+                with target.begin() as dst:
+                    dst.execute(insert(table), [dict(row) for row in partition])
+                copied[table.name] += len(partition)
+            logger.info(f"copied {copied[table.name]} rows of {table.name}")
+
+    return copied
+
+
+@click.command()
+@click.option("--settings", required=True, help="Location of your settings.toml file.")
+@click.option("--output", required=True, type=Path, help="SQLite file to create.")
+@click.option("--overwrite", is_flag=True, help="Replace the output file if it exists.")
+@click.option("--batch_size", default=10_000, help="Rows inserted per transaction.")
+def main(settings, output: Path, overwrite: bool, batch_size: int):
+    if output.exists():
+        if not overwrite:
+            raise click.UsageError(f"{output} exists, pass --overwrite to replace it")
+        output.unlink()
+
+    source = make_engine(settings)
+    target = create_database_engine(f"sqlite:///{output}")
+    export_database(source, target, batch_size)
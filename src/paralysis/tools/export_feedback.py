@@ -0,0 +1,158 @@
+from pathlib import Path
+
+import click
+import pyarrow as pa
+import pyarrow.parquet as pq
+from loguru import logger
+from sqlalchemy import Engine, func, select
+from sqlalchemy.orm import Session
+
+from paralysis.blackbox.flatten import feedback_dtypes, feedback_frame, flatten_feedback
+from paralysis.model import Feedback, Round
+from paralysis.settings import make_engine
+
+# Parquet metadata key holding the newest round a partition was exported up to.
+EXPORTED_THROUGH_KEY = b"paralysis.exported_through_round"
+
+
+def partition_path(key_dir: Path, start: int, end: int) -> Path:
+    return key_dir / f"rounds_{start:07d}_{end:07d}.parquet"
+
+
+def exported_through(path: Path, schema: pa.Schema | None = None) -> int | None:
+    """
+    The newest round in the database when `path` was written, or None if it
+    doesn't exist, was written before this was recorded, or has other
+    columns or types than `schema`.
+    """
+    if not path.exists():
+        return None
+    written = pq.read_schema(path)
+    if schema is not None and not written.remove_metadata().equals(
+        schema.remove_metadata()
+    ):
+        return None
+    metadata = written.metadata or dict()
+    value = metadata.get(EXPORTED_THROUGH_KEY)
+    return int(value) if value is not None else None
+
+
+def export_feedback(
+    engine: Engine,
+    output_dir: Path,
+    key_names: list[str],
+    partition_size: int = 1000,
+    start_round: int | None = None,
+    end_round: int | None = None,
+    overwrite: bool = False,
+):
+    """
+    Write each key in `key_names` to `output_dir/key_name=<key>/` as one
+    Parquet file per `partition_size` rounds. Each file records the newest
+    round in the database when it was written, and is skipped on later runs
+    unless rounds in its range have been added since or `overwrite` is set.
+
+    All files of a key share one schema, worked out from every round of the
+    key by `feedback_dtypes` before writing, so the key's directory reads as
+    one dataset. Files written with another schema, e.g. before a column
+    turned out to hold floats, are written again.
+    """
+    with Session(engine) as session:
+        first_round, last_round = session.execute(
+            select(func.min(Round.id), func.max(Round.id))
+        ).one()
+        if first_round is None:
+            logger.info("no rounds to export")
+            return
+
+        first_round = max(first_round, start_round or first_round)
+        end_round = min(last_round, end_round or last_round)
+        first_partition = first_round - first_round % partition_size
+
+        for key_name in key_names:
+            key_dir = output_dir / f"key_name={key_name}"
+            key_dir.mkdir(parents=True, exist_ok=True)
+            dtypes = feedback_dtypes(
+                row
+                for fb in session.scalars(
+                    select(Feedback)
+                    .where(Feedback.key_name == key_name)
+                    .execution_options(yield_per=500)
+                )
+                for row in flatten_feedback(fb.round_id, fb.json_data())
+            )
+            session.expunge_all()
+            schema = pa.Schema.from_pandas(
+                feedback_frame([], dtypes), preserve_index=False
+            )
+
+            for start in range(first_partition, end_round + 1, partition_size):
+                end = start + partition_size - 1
+                path = partition_path(key_dir, start, end)
+                through = min(end, last_round)
+                previous = exported_through(path, schema)
+                if previous is not None and previous >= through and not overwrite:
+                    continue
+
+                query = (
+                    select(Feedback)
+                    .where(
+                        Feedback.key_name == key_name,
+                        Feedback.round_id.between(start, end),
+                    )
+                    .order_by(Feedback.round_id)
+                    .execution_options(yield_per=500)
+                )
+                rows = list()
+                for fb in session.scalars(query):
+                    rows.extend(flatten_feedback(fb.round_id, fb.json_data()))
+                session.expunge_all()
+
+                if not rows:
+                    continue
+
+                table = pa.Table.from_pandas(
+                    feedback_frame(rows, dtypes), schema=schema, preserve_index=False
+                )
+                table = table.replace_schema_metadata(
+                    {**schema.metadata, EXPORTED_THROUGH_KEY: str(through).encode()}
+                )
+                tmp_path = path.with_suffix(".tmp")
+                pq.write_table(table, tmp_path)
+                tmp_path.replace(path)
+                logger.info(f"wrote key_name={key_name} rounds={start}-{end} rows={len(rows)}")
+
+
+@click.command()
+@click.option("--settings", required=True, help="Location of your settings.toml file.")
+@click.option("--output_dir", required=True, type=Path)
+@click.option(
+    "--key_name",
+    "key_names",
+    required=True,
+    multiple=True,
+    help="Feedback key to export. May be given more than once.",
+)
+@click.option("--partition_size", default=1000, help="Rounds per Parquet file.")
+@click.option("--start_round", type=int, help="First round whose partition is written.")
+@click.option("--end_round", type=int, help="Last round whose partition is written.")
+@click.option("--overwrite", is_flag=True, help="Rewrite already exported partitions.")
+def main(
+    settings,
+    output_dir: Path,
+    key_names: tuple[str],
+    partition_size: int,
+    start_round: int | None,
+    end_round: int | None,
+    overwrite: bool,
+):
+    engine = make_engine(settings)
+    export_feedback(
+        engine,
+        output_dir,
+        list(key_names),
+        partition_size,
+        start_round,
+        end_round,
+        overwrite,
+    )
@@ -6,11 +6,10 @@ from pathlib import Path
 import click
 from avulto import DMM
 from PIL import Image, ImageDraw, ImageFont
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 import typed_settings as ts
 
-from paralysis.settings import ParalysisSettings
+from paralysis.settings import ParalysisSettings, create_database_engine
 from paralysis.model import Round
 
 ZOOM_LEVEL = 4
@@ -253,7 +252,7 @@ def main(settings, output_path: Path, round_id: int):
         ParalysisSettings, appname="paralysis", config_files=[settings]
     )
 
-    engine = create_engine(settings.connection_string)
+    engine = create_database_engine(settings.connection_string)
     with Session(engine) as session:
         # round = session.get(Round, int(round_id))
         # if not round.has_feedback("ruin_placement"):
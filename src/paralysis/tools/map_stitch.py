@@ -4,57 +4,586 @@
 # All .pngs in the rawimages folder will be processed. Exported file may be
 # overwritten in the output.
 
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import hashlib
+import json
+import os
 from pathlib import Path
+import time
 
 import click
+import cv2
+import numpy as np
+import rasterio
 from PIL import Image
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.windows import Window
+
+BACKGROUND = (0, 0, 0, 255)
+GEOTIFF_SUFFIXES = (".tif", ".tiff")
+MANIFEST_SUFFIX = ".manifest.json"
+
+
+@dataclass(frozen=True)
+class StitchLayout:
+    """Canvas and chunk sizes in pixels, from the Mass-Screenshot verb values."""
+
+    width: int
+    height: int
+    pixel_size: int
+    chunk_size: int
+
+    @staticmethod
+    def from_verb_values(verb_values) -> "StitchLayout":
+        pixel_size = verb_values[3]
+        half_chunk_size = verb_values[2]
+        width = verb_values[0] + half_chunk_size - 2
+        height = verb_values[1] + half_chunk_size - 2
+        if (
+            width < 1
+            or height < 1
+            or pixel_size < 1
+            or half_chunk_size < 1
+            or half_chunk_size * 2 >= width
+            or half_chunk_size * 2 >= height
+        ):
+            raise ValueError("Invalid arguments!")
+        return StitchLayout(
+            width=width * pixel_size,
+            height=height * pixel_size,
+            pixel_size=pixel_size,
+            chunk_size=half_chunk_size * 2 * pixel_size - pixel_size,
+        )
+
+    def positions(self, count: int) -> list[tuple[int, int]]:
+        """
+        Top-left corners of `count` chunks in screenshot order: rows left to
+        right from the bottom of the map up, with the last chunk of each row
+        and the top row clamped to the canvas.
+        """
+        positions = list()
+        x = 0
+        y = self.height - self.chunk_size
+        for _ in range(count):
+            positions.append((x, y))
+            x += self.chunk_size
+            if x >= self.width:
+                x = 0
+                y = max(y - self.chunk_size, 0)
+            x = min(x, self.width - self.chunk_size)
+        return positions
+
+
+def new_canvas(layout: StitchLayout, memmap_path: Path | None = None) -> np.ndarray:
+    """
+    An RGBA canvas filled with the background colour, held in memory or, if
+    `memmap_path` is given, memory-mapped from a `.npy` file there.
+    """
+    shape = (layout.height, layout.width, 4)
+    if memmap_path is None:
+        canvas = np.empty(shape, dtype=np.uint8)
+    else:
+        canvas = np.lib.format.open_memmap(
+            memmap_path, mode="w+", dtype=np.uint8, shape=shape
+        )
+    canvas[:] = BACKGROUND
+    return canvas
+
+
+@dataclass
+class Placement:
+    """
+    Where a screenshot was expected by the verb values and where it went.
+    `slot_shift` counts the slots it was moved along by alignment, e.g. 1 if
+    a screenshot before it is missing, and `rect` is the `(x0, y0, x1, y1)`
+    rectangle of the canvas it covers.
+    """
+
+    image_file: Path
+    expected: tuple[int, int]
+    position: tuple[int, int]
+    slot: int
+    score: float | None = None
+    slot_shift: int = 0
+    rect: tuple[int, int, int, int] | None = None
+
+    @property
+    def misplaced(self) -> bool:
+        return self.position != self.expected
+
+
+def match_overlap(
+    canvas: np.ndarray,
+    placed: list[tuple[int, int, int, int]],
+    chunk: np.ndarray,
+    x: int,
+    y: int,
+    search: int,
+    min_overlap: int = 8,
+) -> tuple[tuple[int, int], float] | None:
+    """
+    Find the position within `search` pixels of `(x, y)` where `chunk` best
+    matches the already placed chunk it overlaps most, out of the `placed`
+    `(x0, y0, x1, y1)` rectangles. Returns the position and its normalized
+    correlation, or None if the overlap is too small or too featureless to
+    match against.
+    """
+    if not placed:
+        return None
+    height, width = chunk.shape[:2]
+    rects = np.asarray(placed)
+    x0 = np.maximum(rects[:, 0], x)
+    y0 = np.maximum(rects[:, 1], y)
+    x1 = np.minimum(rects[:, 2], x + width)
+    y1 = np.minimum(rects[:, 3], y + height)
+    overlap_width = x1 - x0
+    overlap_height = y1 - y0
+    area = np.where(
+        (overlap_width > 0) & (overlap_height > 0), overlap_width * overlap_height, 0
+    )
+    best = area.argmax()
+    if min(overlap_width[best], overlap_height[best]) < 2 * search + min_overlap:
+        return None
+
+    # The template is the chunk's side of the overlap, inset by the search
+    # radius so it stays inside the placed pixels at every offset tried.
+    x0, y0, x1, y1 = x0[best], y0[best], x1[best], y1[best]
+    template = chunk[
+        y0 - y + search : y1 - y - search, x0 - x + search : x1 - x - search, :3
+    ]
+    if template.std() < 1:
+        return None
+    scores = cv2.matchTemplate(
+        np.ascontiguousarray(canvas[y0:y1, x0:x1, :3]),
+        np.ascontiguousarray(template),
+        cv2.TM_CCOEFF_NORMED,
+    )
+    _, score, _, (dx, dy) = cv2.minMaxLoc(scores)
+    if scores[search, search] >= score - 1e-6:
+        dx = dy = search
+    return (x + dx - search, y + dy - search), float(scores[dy, dx])
+
+
+def align_chunk(
+    canvas: np.ndarray,
+    placed: list[tuple[int, int, int, int]],
+    chunk: np.ndarray,
+    slots: list[tuple[int, int]],
+    slot: int,
+    search: int,
+    min_score: float,
+) -> tuple[int, tuple[int, int], float | None]:
+    """
+    Place `chunk`, expected at `slots[slot]`, by matching it against the
+    chunks placed before it. If it doesn't match within `search` pixels
+    there, the neighbouring slots are tried, which catches screenshots that
+    were dropped or taken out of order. Returns the slot used, the position
+    and the match score, which is None if nothing could be matched.
+    """
+    expected = match_overlap(canvas, placed, chunk, *slots[slot], search)
+    if expected is not None and expected[1] >= min_score:
+        return slot, *expected
+
+    candidates = list()
+    for neighbour in (slot + 1, slot - 1):
+        if 0 <= neighbour < len(slots):
+            match = match_overlap(canvas, placed, chunk, *slots[neighbour], search)
+            if match is not None and match[1] >= min_score:
+                candidates.append((match[1], neighbour, match[0]))
+    if candidates:
+        score, neighbour, position = max(candidates)
+        return neighbour, position, score
+    return slot, slots[slot], None if expected is None else expected[1]
+
+
+def load_canvas(
+    layout: StitchLayout, output_filepath: Path, memmap_path: Path | None = None
+) -> np.ndarray | None:
+    """
+    The canvas of an earlier stitch, from its memory-mapped `.npy` file if
+    there is one, or else from its output image. If `memmap_path` is given,
+    the canvas is kept memory-mapped there either way. None if neither exists
+    or the size doesn't match `layout`.
+    """
+    shape = (layout.height, layout.width, 4)
+    if memmap_path is not None and memmap_path.exists():
+        canvas = np.lib.format.open_memmap(memmap_path, mode="r+")
+        return canvas if canvas.shape == shape else None
+    if not output_filepath.exists():
+        return None
+
+    if output_filepath.suffix.lower() in GEOTIFF_SUFFIXES:
+        with rasterio.open(output_filepath) as src:
+            image = src.read().transpose(1, 2, 0)
+    else:
+        with Image.open(output_filepath) as output:
+            image = np.asarray(output.convert("RGBA"))
+    if image.shape != shape:
+        return None
+    canvas = new_canvas(layout, memmap_path)
+    canvas[:] = image
+    return canvas
+
+
+def overlaps(a, b) -> bool:
+    """Whether two `(x0, y0, x1, y1)` rectangles overlap."""
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def file_sha256(image_file: Path) -> str:
+    with open(image_file, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def load_manifest(manifest_path: Path, verb_values) -> dict[str, dict]:
+    """
+    The chunks placed by an earlier stitch, by file name, or nothing if there
+    wasn't one or it used other verb values.
+    """
+    if not manifest_path.exists():
+        return dict()
+    manifest = json.loads(manifest_path.read_text())
+    if manifest["verb_values"] != list(verb_values):
+        return dict()
+    return manifest["chunks"]
+
+
+def write_manifest(manifest_path: Path, verb_values, chunks: dict[str, dict]):
+    manifest = dict(verb_values=list(verb_values), chunks=chunks)
+    manifest_path.write_text(json.dumps(manifest))
+
+
+def decode_chunk(image_file: Path) -> np.ndarray:
+    with Image.open(image_file) as photo:
+        return np.asarray(photo.convert("RGBA"))
+
+
+def paste(
+    canvas: np.ndarray, chunk: np.ndarray, x: int, y: int
+) -> tuple[int, int, int, int]:
+    """
+    Copy `chunk` onto `canvas` at `(x, y)`, cropped to the canvas like PIL's
+    paste. Returns the `(x0, y0, x1, y1)` rectangle that was covered.
+    """
+    crop_x = max(-x, 0)
+    crop_y = max(-y, 0)
+    x, y = max(x, 0), max(y, 0)
+    height = min(chunk.shape[0] - crop_y, canvas.shape[0] - y)
+    width = min(chunk.shape[1] - crop_x, canvas.shape[1] - x)
+    canvas[y : y + height, x : x + width] = chunk[
+        crop_y : crop_y + height, crop_x : crop_x + width
+    ]
+    return x, y, x + width, y + height
+
+
+def stitch(
+    canvas: np.ndarray,
+    image_files: list[Path],
+    positions: list[tuple[int, int]],
+    workers: int | None = None,
+    search: int | None = None,
+    min_score: float = 0.9,
+    slots: list[int] | None = None,
+    placed: list[tuple[int, int, int, int]] | None = None,
+    fixed: list[tuple[int, int] | None] | None = None,
+) -> list[Placement]:
+    """
+    Decode `image_files` on a pool of `workers` threads and paste each at its
+    position. Pillow releases the GIL while decoding, so decodes run in
+    parallel. Chunks are pasted in order, so where chunks overlap the later
+    one wins, and at most a few chunks per worker are held decoded at once.
+
+    With a `search` radius, each chunk is aligned against the chunks before
+    it with `align_chunk`, and once a chunk turns out to belong in another
+    slot, the chunks after it are expected to be shifted the same way.
+    `positions` may then hold more slots than there are files.
+
+    `slots` gives the slot each file is expected in, by default its place in
+    `image_files`, and `placed` the rectangles already covered on `canvas`,
+    for adding chunks to an earlier stitch. A position in `fixed` pastes its
+    file there as is, for chunks an earlier stitch already placed.
+    """
+    workers = workers or os.cpu_count() or 1
+    window = workers * 4
+    started = time.perf_counter()
+    pixels = 0
+    placements = list()
+    slots = list(range(len(image_files))) if slots is None else slots
+    fixed = [None] * len(image_files) if fixed is None else fixed
+    placed = list(placed or ())
+    slot_shift = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for start in range(0, len(image_files), window):
+            batch = image_files[start : start + window]
+            chunks = pool.map(decode_chunk, batch)
+            for i, (image_file, chunk) in enumerate(zip(batch, chunks), start):
+                expected = min(slots[i], len(positions) - 1)
+                position = fixed[i] or positions[expected]
+                placement = Placement(image_file, position, position, expected)
+                if search is not None and fixed[i] is None:
+                    slot = min(expected + slot_shift, len(positions) - 1)
+                    slot, placement.position, placement.score = align_chunk(
+                        canvas, placed, chunk, positions, slot, search, min_score
+                    )
+                    placement.slot = slot
+                    placement.slot_shift = slot_shift = slot - expected
+                placement.rect = paste(canvas, chunk, *placement.position)
+                placed.append(placement.rect)
+                placements.append(placement)
+                pixels += chunk.shape[0] * chunk.shape[1]
+
+            done = start + len(batch)
+            elapsed = time.perf_counter() - started
+            print(
+                f"{done / len(image_files) * 100:.1f} % "
+                f"({done / elapsed:.1f} chunks/s, {pixels / elapsed / 1e6:.1f} MP/s)"
+            )
+
+    return placements
+
+
+def write_geotiff(
+    canvas: np.ndarray,
+    output_filepath: Path,
+    pixel_size: int,
+    tile_size: int = 512,
+    compress: str = "deflate",
+):
+    """
+    Write `canvas` to a tiled, compressed RGBA GeoTIFF, as a BigTIFF if it
+    needs to be, one strip of `tile_size` rows at a time, then add overviews
+    down to a single tile. The transform puts the origin at the bottom left
+    of the map with one unit per map tile.
+    """
+    height, width, bands = canvas.shape
+    profile = dict(
+        driver="GTiff",
+        width=width,
+        height=height,
+        count=bands,
+        dtype="uint8",
+        tiled=True,
+        blockxsize=tile_size,
+        blockysize=tile_size,
+        compress=compress,
+        photometric="RGB",
+        alpha="YES",
+        bigtiff="IF_SAFER",
+        transform=Affine(1 / pixel_size, 0, 0, 0, -1 / pixel_size, height / pixel_size),
+    )
+    with rasterio.open(output_filepath, "w", **profile) as dst:
+        for row in range(0, height, tile_size):
+            strip = canvas[row : row + tile_size]
+            dst.write(
+                strip.transpose(2, 0, 1),
+                window=Window(0, row, width, strip.shape[0]),
+            )
+
+        factors = list()
+        factor = 2
+        while max(width, height) / factor >= tile_size:
+            factors.append(factor)
+            factor *= 2
+        if factors:
+            dst.build_overviews(factors, Resampling.average)
 
 
 @click.command()
 @click.option("--input_dir", required=True, type=Path)
 @click.option("--output_dir", required=True, type=Path)
-@click.option("--output_filename", required=True)
+@click.option(
+    "--output_filename",
+    required=True,
+    help="Name of the map image. Ending in .tif or .tiff writes a tiled GeoTIFF.",
+)
 @click.option("--verb_values", nargs=4, type=int)
-def main(input_dir, output_dir, output_filename, verb_values):
-    pixel_size = verb_values[3]
-    half_chunk_size = verb_values[2]
-    width = verb_values[0] + half_chunk_size - 2
-    height = verb_values[1] + half_chunk_size - 2
-    if (
-        width < 1
-        or height < 1
-        or pixel_size < 1
-        or half_chunk_size < 1
-        or half_chunk_size * 2 >= width
-        or half_chunk_size * 2 >= height
-    ):
-        print("Invalid arguments!")
+@click.option("--workers", type=int, help="Decoding threads. Defaults to one per core.")
+@click.option(
+    "--memmap",
+    is_flag=True,
+    help="Keep the canvas in a .npy file in output_dir instead of in memory.",
+)
+@click.option(
+    "--align",
+    is_flag=True,
+    help="Check each screenshot against its neighbours and move it if it is off.",
+)
+@click.option(
+    "--search_radius", default=8, help="Pixels around its slot a screenshot is searched."
+)
+@click.option(
+    "--min_score", default=0.9, help="Correlation needed to accept an alignment."
+)
+@click.option(
+    "--rebuild", is_flag=True, help="Stitch every screenshot, not just new ones."
+)
+def main(
+    input_dir,
+    output_dir,
+    output_filename,
+    verb_values,
+    workers,
+    memmap,
+    align,
+    search_radius,
+    min_score,
+    rebuild,
+):
+    try:
+        layout = StitchLayout.from_verb_values(verb_values)
+    except ValueError as e:
+        print(e)
         exit(1)
-    width *= pixel_size
-    height *= pixel_size
-    half_chunk_size *= pixel_size
 
-    masterexport = Image.new("RGBA", (width, height), color=(0, 0, 0, 255))
     imagelist = sorted(input_dir.glob("*.png"), key=lambda x: x.stat().st_mtime)
-    imagecount = len(imagelist)
-    chunk_size = half_chunk_size * 2 - pixel_size
-    x = fc = 0
-    y = height - chunk_size
-
-    # For loop stitches raw images together
-    for image_file in imagelist:
-        photo = Image.open(image_file).convert("RGBA")
-        masterexport.paste(photo, (x, y))
-        x += chunk_size
-        fc += 1
-        if x >= width:
-            x = 0
-            y -= chunk_size
-            y = max(y, 0)
-            progress = fc / imagecount * 100
-            print("%.1f" % progress, "%")
-        x = min(x, width - chunk_size)
-
     output_filepath = output_dir / output_filename
+
+    memmap_path = output_filepath.with_suffix(".canvas.npy") if memmap else None
+    manifest_path = output_filepath.with_suffix(MANIFEST_SUFFIX)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        digests = dict(zip(imagelist, pool.map(file_sha256, imagelist)))
+    manifest = load_manifest(manifest_path, verb_values)
+    canvas = None
+    if manifest and not rebuild:
+        canvas = load_canvas(layout, output_filepath, memmap_path)
+    stitched = canvas is not None
+    if canvas is None:
+        canvas = new_canvas(layout, memmap_path)
+
+    # Screenshots from an earlier stitch keep the slot and position recorded
+    # for them, even if they were replaced since, and new ones follow them in
+    # the order they were taken. With --align, leave room for every new
+    # screenshot to be moved along a slot.
+    recorded = sorted(
+        (image_file for image_file in imagelist if image_file.name in manifest),
+        key=lambda image_file: manifest[image_file.name]["slot"],
+    )
+    added = [image_file for image_file in imagelist if image_file.name not in manifest]
+    first_added = max((entry["slot"] for entry in manifest.values()), default=-1) + 1
+    positions = layout.positions((first_added + len(added)) * (2 if align else 1))
+
+    def rect(image_file: Path) -> tuple[int, int, int, int]:
+        x, y = manifest[image_file.name]["position"]
+        with Image.open(image_file) as photo:
+            return (x, y, x + photo.width, y + photo.height)
+
+    # Screenshots whose contents haven't changed are already on the canvas.
+    # Changed ones are cleared off it, and everything overlapping a cleared
+    # or repasted rectangle is pasted again, in slot order, so the result is
+    # the same as stitching everything again.
+    changed = [
+        image_file
+        for image_file in recorded
+        if not stitched or manifest[image_file.name]["sha256"] != digests[image_file]
+    ]
+    dirty = list()
+    for image_file in changed:
+        x0, y0, x1, y1 = manifest[image_file.name]["rect"]
+        canvas[y0:y1, x0:x1] = BACKGROUND
+        dirty.extend([(x0, y0, x1, y1), rect(image_file)])
+    repaste = set(changed)
+    while True:
+        overlapping = [
+            image_file
+            for image_file in recorded
+            if image_file not in repaste
+            and any(overlaps(manifest[image_file.name]["rect"], r) for r in dirty)
+        ]
+        if not overlapping:
+            break
+        repaste.update(overlapping)
+        dirty.extend(tuple(manifest[f.name]["rect"]) for f in overlapping)
+
+    chunks = {
+        image_file.name: manifest[image_file.name]
+        for image_file in recorded
+        if image_file not in repaste
+    }
+    if stitched:
+        print(
+            f"{len(chunks)} screenshots already stitched, "
+            f"{len(repaste)} to paste again, {len(added)} new"
+        )
+    pending = [image_file for image_file in recorded if image_file in repaste]
+    slots = [manifest[image_file.name]["slot"] for image_file in pending]
+    fixed = [tuple(manifest[image_file.name]["position"]) for image_file in pending]
+    pending.extend(added)
+    slots.extend(range(first_added, first_added + len(added)))
+    fixed.extend([None] * len(added))
+
+    removed = manifest.keys() - {image_file.name for image_file in imagelist}
+    if removed and stitched:
+        print(
+            f"{len(removed)} screenshots were removed since the last stitch but are "
+            "still on the map, pass --rebuild to leave them out"
+        )
+        # Keep them in the manifest, they still hold their slots.
+        chunks.update((name, manifest[name]) for name in removed)
+    placed = [tuple(entry["rect"]) for entry in chunks.values()]
+    if not pending and output_filepath.exists():
+        # The map is up to date, but removed screenshots may have to be noted.
+        write_manifest(manifest_path, verb_values, chunks)
+        return
+
+    placements = stitch(
+        canvas,
+        pending,
+        positions,
+        workers,
+        search_radius if align else None,
+        min_score,
+        slots,
+        placed,
+        fixed,
+    )
+
+    if align:
+        # Only new screenshots are aligned, the rest keep their positions.
+        aligned = [p for p in placements if p.image_file.name not in manifest]
+        slot_shift = 0
+        for placement in aligned:
+            name = placement.image_file.name
+            if placement.slot_shift != slot_shift:
+                change = placement.slot_shift - slot_shift
+                print(
+                    f"{name}: {abs(change)} screenshot(s) "
+                    f"{'missing' if change > 0 else 'too many'} before it, "
+                    f"moved to {placement.position} (score {placement.score:.3f})"
+                )
+                slot_shift = placement.slot_shift
+            elif placement.position != positions[placement.slot]:
+                print(
+                    f"{name}: moved from {positions[placement.slot]} "
+                    f"to {placement.position} (score {placement.score:.3f})"
+                )
+        unmatched = [p.image_file.name for p in aligned if p.score is None]
+        poor = [
+            p.image_file.name
+            for p in aligned
+            if p.score is not None and p.score < min_score
+        ]
+        print(
+            f"{sum(p.misplaced for p in aligned)} screenshots moved, "
+            f"{len(poor)} poorly matched, {len(unmatched)} without enough overlap to check"
+        )
+        if poor:
+            print("Poorly matched: " + ", ".join(poor))
+
     print(output_filepath)
-    masterexport.save(output_filepath)
+    if output_filepath.suffix.lower() in GEOTIFF_SUFFIXES:
+        write_geotiff(canvas, output_filepath, layout.pixel_size)
+    else:
+        Image.fromarray(canvas, "RGBA").save(output_filepath)
+
+    for placement in placements:
+        chunks[placement.image_file.name] = dict(
+            sha256=digests[placement.image_file],
+            slot=placement.slot,
+            position=placement.position,
+            rect=placement.rect,
+        )
+    write_manifest(manifest_path, verb_values, chunks)
@@ -0,0 +1,133 @@
+from dataclasses import dataclass
+
+import click
+from loguru import logger
+from sqlalchemy import Engine, Executable, Index, Table, inspect, text
+from sqlalchemy.schema import CreateColumn, CreateIndex, CreateTable
+
+from paralysis.model import Base
+from paralysis.settings import make_engine
+
+
+@dataclass(frozen=True)
+class Migration:
+    """One difference between the model and the database, and the DDL fixing it."""
+
+    description: str
+    statement: Executable
+
+
+def _has_index(existing: list[dict], index: Index) -> bool:
+    columns = [c.name for c in index.columns]
+    return any(
+        ix["name"] == index.name
+        or (ix["column_names"] == columns and bool(ix["unique"]) == bool(index.unique))
+        for ix in existing
+    )
+
+
+def _table_migrations(engine: Engine, table: Table) -> list[Migration]:
+    inspector = inspect(engine)
+    existing = {c["name"]: c for c in inspector.get_columns(table.name)}
+    migrations = list()
+
+    quote = engine.dialect.identifier_preparer.quote
+    for column in table.columns:
+        ddl = CreateColumn(column).compile(dialect=engine.dialect)
+        if column.name not in existing:
+            references = [
+                f"{quote(fk.column.table.name)} ({quote(fk.column.name)})"
+                for fk in column.foreign_keys
+            ]
+            if engine.dialect.name == "sqlite":
+                # SQLite can't add constraints later, only inline with the column.
+                ddl = " ".join([str(ddl), *(f"REFERENCES {r}" for r in references)])
+                references = []
+            migrations.append(
+                Migration(
+                    f"add column {table.name}.{column.name}",
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {ddl}"),
+                )
+            )
+            migrations.extend(
+                Migration(
+                    f"add foreign key {table.name}.{column.name} to {reference}",
+                    text(
+                        f"ALTER TABLE {table.name} ADD FOREIGN KEY "
+                        f"({quote(column.name)}) REFERENCES {reference}"
+                    ),
+                )
+                for reference in references
+            )
+        elif column.nullable and not existing[column.name]["nullable"]:
+            if engine.dialect.name not in ("mysql", "mariadb"):
+                logger.warning(
+                    f"{table.name}.{column.name} should be nullable, "
+                    f"change it by hand on {engine.dialect.name}"
+                )
+                continue
+            migrations.append(
+                Migration(
+                    f"make {table.name}.{column.name} nullable",
+                    text(f"ALTER TABLE {table.name} MODIFY COLUMN {ddl}"),
+                )
+            )
+
+    indexes = inspector.get_indexes(table.name)
+    for index in sorted(table.indexes, key=lambda ix: ix.name):
+        if not _has_index(indexes, index):
+            migrations.append(
+                Migration(f"create index {index.name} on {table.name}", CreateIndex(index))
+            )
+
+    return migrations
+
+
+def pending_migrations(
+    engine: Engine, tables: list[Table] | None = None
+) -> list[Migration]:
+    """
+    Everything needed to bring an existing database up to the current model:
+    missing tables, columns added since the database was created along with
+    their foreign keys, columns that have become nullable, and missing
+    indexes. Indexes count as present if one with the same name or the same
+    columns exists. Only `tables` are checked if given.
+    """
+    existing_tables = set(inspect(engine).get_table_names())
+    migrations = list()
+    for table in tables or Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            migrations.append(Migration(f"create table {table.name}", CreateTable(table)))
+            migrations.extend(
+                Migration(f"create index {index.name} on {table.name}", CreateIndex(index))
+                for index in sorted(table.indexes, key=lambda ix: ix.name)
+            )
+        else:
+            migrations.extend(_table_migrations(engine, table))
+    return migrations
+
+
+def migrate_schema(
+    engine: Engine, dry_run: bool = False, tables: list[Table] | None = None
+) -> list[Migration]:
+    """Apply `pending_migrations`, or only log them if `dry_run` is set."""
+    migrations = pending_migrations(engine, tables)
+    for migration in migrations:
+        if dry_run:
+            logger.info(f"missing: {migration.description}")
+            continue
+        logger.info(migration.description)
+        with engine.begin() as conn:
+            conn.execute(migration.statement)
+
+    if not migrations:
+        logger.info("database schema is up to date")
+    return migrations
+
+
+@click.command()
+@click.option("--settings", required=True, help="Location of your settings.toml file.")
+@click.option("--dry_run", is_flag=True, help="Only report what is missing.")
+def main(settings, dry_run: bool):
+    engine = make_engine(settings)
+    migrate_schema(engine, dry_run)
@@ -0,0 +1,199 @@
+from datetime import datetime
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+from loguru import logger
+from sqlalchemy import Engine, select
+
+from paralysis.model import ProfilerRoundRollup, ProfilerSample, Round
+from paralysis.settings import make_engine
+
+
+def load_round_values(
+    engine: Engine,
+    metric: str,
+    procs: list[str] | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+) -> pd.DataFrame:
+    """
+    The median of `metric` over each round's samples of each proc, with the
+    round's commit and start time, for rounds with a known commit. Read from
+    `profiler_round_rollup`, so rounds whose raw samples have been pruned are
+    included.
+    """
+    query = (
+        select(
+            ProfilerRoundRollup.proc_path,
+            ProfilerRoundRollup.round_id,
+            ProfilerRoundRollup.p50.label("value"),
+            Round.commit_hash,
+            Round.start_datetime,
+        )
+        .join(Round, Round.id == ProfilerRoundRollup.round_id)
+        .where(
+            ProfilerRoundRollup.metric == metric,
+            ProfilerRoundRollup.p50.is_not(None),
+            Round.commit_hash.is_not(None),
+            Round.start_datetime.is_not(None),
+        )
+    )
+    if procs:
+        query = query.where(ProfilerRoundRollup.proc_path.in_(procs))
+    if start is not None:
+        query = query.where(Round.start_datetime >= start)
+    if end is not None:
+        query = query.where(Round.start_datetime < end)
+
+    with engine.connect() as conn:
+        round_values = pd.read_sql_query(query, conn, parse_dates=["start_datetime"])
+    return round_values.astype({"value": "float64"})
+
+
+def bootstrap_median_change(
+    values: np.ndarray,
+    baseline: np.ndarray,
+    rng: np.random.Generator,
+    resamples: int = 2000,
+    confidence: float = 0.95,
+) -> tuple[float, float]:
+    """
+    Bootstrap confidence interval of the relative change between the median
+    of `baseline` and the median of `values`, resampling both at once.
+    """
+    value_medians = np.median(
+        values[rng.integers(0, len(values), (resamples, len(values)))], axis=1
+    )
+    baseline_medians = np.median(
+        baseline[rng.integers(0, len(baseline), (resamples, len(baseline)))], axis=1
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        changes = value_medians / baseline_medians - 1
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.nanpercentile(changes, [tail, 100 - tail])
+    return float(low), float(high)
+
+
+def find_regressions(
+    round_values: pd.DataFrame,
+    baseline_commits: int = 5,
+    min_rounds: int = 3,
+    threshold: float = 0.1,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """
+    Compare each commit's rounds of each proc to the rounds of the
+    `baseline_commits` commits before it, ordered by when each commit was
+    first seen. A commit is flagged as a regression when both sides have at
+    least `min_rounds` rounds and the whole confidence interval of the median
+    change is above `threshold`. Later commits are then only compared to the
+    flagged commit onwards, so one slowdown is reported once.
+    """
+    rng = np.random.default_rng(seed)
+
+    by_commit = round_values.groupby(["proc_path", "commit_hash"])
+    commits = by_commit.agg(
+        first_round_start=("start_datetime", "min"),
+        rounds=("round_id", "size"),
+        median=("value", "median"),
+    )
+    commits["p90"] = by_commit["value"].quantile(0.9)
+    commits = commits.reset_index().sort_values(
+        ["proc_path", "first_round_start"], kind="stable"
+    )
+    values = {key: group.to_numpy() for key, group in by_commit["value"]}
+
+    results = list()
+    for proc_path, proc_commits in commits.groupby("proc_path", sort=False):
+        order = proc_commits.commit_hash.tolist()
+        baseline_start = 0
+        for i, row in enumerate(proc_commits.itertuples(index=False)):
+            current = values[(proc_path, row.commit_hash)]
+            previous = order[max(baseline_start, i - baseline_commits) : i]
+            baseline = np.concatenate(
+                [values[(proc_path, c)] for c in previous] or [np.empty(0)]
+            )
+
+            result = row._asdict()
+            result.update(
+                baseline_rounds=len(baseline),
+                baseline_median=np.median(baseline) if len(baseline) else np.nan,
+                ci_low=np.nan,
+                ci_high=np.nan,
+                regression=False,
+            )
+            if len(current) >= min_rounds and len(baseline) >= min_rounds:
+                result["ci_low"], result["ci_high"] = bootstrap_median_change(
+                    current, baseline, rng
+                )
+                if result["ci_low"] > threshold:
+                    result["regression"] = True
+                    baseline_start = i
+            results.append(result)
+
+    report = pd.DataFrame(
+        results,
+        columns=[
+            *commits.columns,
+            "baseline_rounds",
+            "baseline_median",
+            "ci_low",
+            "ci_high",
+            "regression",
+        ],
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        report.insert(
+            len(report.columns) - 1,
+            "change",
+            report["median"] / report["baseline_median"] - 1,
+        )
+    return report
+
+
+@click.command()
+@click.option("--settings", required=True, help="Location of your settings.toml file.")
+@click.option(
+    "--metric", type=click.Choice(ProfilerSample.METRICS), default="self_cpu"
+)
+@click.option(
+    "--proc", "procs", multiple=True, help="Proc to check. May be given more than once."
+)
+@click.option("--start", type=click.DateTime(), help="Only rounds started on or after this.")
+@click.option("--end", type=click.DateTime(), help="Only rounds started before this.")
+@click.option(
+    "--baseline_commits", default=5, help="Earlier commits each commit is compared to."
+)
+@click.option(
+    "--min_rounds", default=3, help="Rounds needed on both sides of a comparison."
+)
+@click.option(
+    "--threshold", default=0.1, help="Relative slowdown that counts as a regression."
+)
+@click.option("--output", type=Path, help="Write every comparison to this CSV file.")
+def main(
+    settings,
+    metric: str,
+    procs: tuple[str],
+    start: datetime | None,
+    end: datetime | None,
+    baseline_commits: int,
+    min_rounds: int,
+    threshold: float,
+    output: Path | None,
+):
+    engine = make_engine(settings)
+    round_values = load_round_values(engine, metric, list(procs), start, end)
+    report = find_regressions(round_values, baseline_commits, min_rounds, threshold)
+
+    if output is not None:
+        report.to_csv(output, index=False)
+    for row in report[report.regression].itertuples():
+        logger.warning(
+            f"{row.proc_path} {metric} regressed at {row.commit_hash[:10]}: "
+            f"median {row.median:.4g} vs {row.baseline_median:.4g} "
+            f"({row.change:+.1%}, CI {row.ci_low:+.1%} to {row.ci_high:+.1%})"
+        )
+    logger.info(f"{report.regression.sum()} regressions in {len(report)} comparisons")
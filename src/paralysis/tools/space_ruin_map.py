@@ -6,12 +6,11 @@ from pathlib import Path
 import click
 from avulto import DMM
 from PIL import Image, ImageDraw, ImageFont
-from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 import typed_settings as ts
 
-from paralysis.settings import ParalysisSettings
-from paralysis.model import Round
+from paralysis.settings import ParalysisSettings, create_database_engine
+from paralysis.model import Round, select_rounds
 
 ZOOM_LEVEL = 4
 
@@ -244,9 +243,11 @@ def main(settings, output_path: Path, round_id: int):
         ParalysisSettings, appname="paralysis", config_files=[settings]
     )
 
-    engine = create_engine(settings.connection_string)
+    engine = create_database_engine(settings.connection_string)
     with Session(engine) as session:
-        round = session.get(Round, int(round_id))
+        round = session.scalars(
+            select_rounds(keys=["ruin_placement"]).where(Round.id == int(round_id))
+        ).one()
         if not round.has_feedback("ruin_placement"):
             raise RuntimeError(f"no ruin placement found for round ID {round.id}")
 
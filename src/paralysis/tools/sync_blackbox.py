@@ -1,17 +1,18 @@
-from datetime import timedelta
-
 import click
 from loguru import logger
-from sqlalchemy import create_engine
 import typed_settings as ts
 
 from paralysis.model import Round
 from paralysis.network import make_cached_limiter_session
-from paralysis.settings import ParalysisSettings
+from paralysis.settings import ParalysisSettings, create_database_engine
 
 
 def sync_blackbox_database(
-    connection_string: str, api_url: str, cache_db: str, enable_logging: bool
+    connection_string: str,
+    api_url: str,
+    cache_db: str,
+    enable_logging: bool,
+    compress_threshold: int | None = None,
 ):
     if enable_logging:
         logger.add(
@@ -22,18 +23,24 @@ def sync_blackbox_database(
         )
     rq_session = make_cached_limiter_session(cache_db)
 
-    engine = create_engine(connection_string)
+    engine = create_database_engine(connection_string)
     logger.info("getting roundstats...")
-    rounds = rq_session.get(
-        f"{api_url}/stats/roundlist", expire_after=timedelta(hours=1)
-    ).json()
+    rounds = rq_session.get(f"{api_url}/stats/roundlist").json()
     for round in rounds:
         round_id = round["round_id"]
         logger.info(f"round_id={round_id}")
-        downloaded = Round.download(engine, round_id, rq_session, api_url)
+        downloaded = Round.download(
+            engine, round_id, rq_session, api_url, compress_threshold
+        )
         if downloaded:
             logger.info(f"downloaded round_id={round_id}")
 
+    for state in rq_session.limiter_state():
+        logger.info(
+            f"rate limit bucket={state.name} interval={state.interval:.0f}s "
+            f"tokens={state.tokens:.1f}/{state.capacity} paused_for={state.paused_for:.1f}s"
+        )
+
 
 @click.command()
 @click.option("--settings", required=True, help="Location of your settings.toml file.")
@@ -48,4 +55,5 @@ def main(settings):
         settings.api_url,
         settings.cache_db,
         settings.log_tasks,
+        settings.feedback_compress_threshold,
     )
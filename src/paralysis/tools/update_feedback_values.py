@@ -0,0 +1,32 @@
+import click
+from sqlalchemy import Engine
+
+from paralysis.model import Feedback, FeedbackValue
+from paralysis.settings import make_engine
+from paralysis.tools.backfill import backfill_derived_rows
+
+
+def update_feedback_values(
+    engine: Engine, rebuild: bool = False, batch_size: int = 200
+) -> int:
+    """
+    Explode tally, nested tally, associative and ledger feedback into
+    `feedback_value` rows for rounds that haven't been processed yet, or for
+    every round if `rebuild` is set. Returns the number of rows written.
+    """
+    return backfill_derived_rows(
+        engine,
+        FeedbackValue,
+        Feedback.key_type.in_(FeedbackValue.NORMALIZED_KEY_TYPES),
+        FeedbackValue.rows,
+        rebuild,
+        batch_size,
+    )
+
+
+@click.command()
+@click.option("--settings", required=True, help="Location of your settings.toml file.")
+@click.option("--rebuild", is_flag=True, help="Recreate the rows for every round.")
+def main(settings, rebuild: bool):
+    engine = make_engine(settings)
+    update_feedback_values(engine, rebuild)
@@ -0,0 +1,199 @@
+from datetime import date, datetime, timedelta
+
+import click
+import pandas as pd
+import typed_settings as ts
+from loguru import logger
+from sqlalchemy import Date, Engine, delete, exists, func, insert, select, tuple_
+from sqlalchemy.orm import Session
+
+from paralysis.model import ProfilerDailyRollup, ProfilerRoundRollup, ProfilerSample
+from paralysis.settings import ParalysisSettings, create_database_engine
+
+
+def rollup_rows(samples: pd.DataFrame, keys: list[str]) -> list[dict]:
+    """
+    Summarize every `ProfilerSample.METRICS` column of `samples` per `keys`
+    and metric, as insertable rollup rows. Missing values aren't counted, and
+    metrics without any values get no row.
+    """
+    values = (
+        samples.melt(
+            id_vars=keys,
+            value_vars=list(ProfilerSample.METRICS),
+            var_name="metric",
+            value_name="value",
+        )
+        .astype({"value": "float64"})
+        .dropna(subset=["value"])
+    )
+    grouped = values.groupby([*keys, "metric"])["value"]
+    stats = grouped.agg(
+        sample_count="size",
+        value_sum="sum",
+        value_min="min",
+        value_max="max",
+        p50="median",
+    )
+    stats["p95"] = grouped.quantile(0.95)
+    return stats.reset_index().astype("object").to_dict("records")
+
+
+def _sample_day():
+    return func.date(ProfilerSample.sample_time, type_=Date)
+
+
+def _has_daily_rollup():
+    return exists().where(
+        ProfilerDailyRollup.day == _sample_day(),
+        ProfilerDailyRollup.proc_path == ProfilerSample.proc_path,
+    )
+
+
+def _load_samples(session: Session, query) -> pd.DataFrame:
+    columns = [ProfilerSample.__table__.c[c] for c in ProfilerSample.METRICS]
+    return pd.read_sql_query(
+        query.add_columns(*columns),
+        session.connection(),
+        parse_dates=["sample_time"],
+    )
+
+
+def update_profiler_rollups(
+    engine: Engine, retention_days: int | None = None, batch_size: int = 200
+) -> int:
+    """
+    Roll up the samples of every round and proc that isn't in
+    `profiler_round_rollup` yet, then recompute `profiler_daily_rollup` for
+    the days and procs those samples fall in, and roll up every day and proc
+    with samples but no daily rollup, however old. Days from before the
+    `retention_days` cutoff that already have a daily rollup are left alone,
+    as their raw samples may have been pruned. Returns the number of round
+    and proc pairs rolled up.
+    """
+    cutoff = retention_cutoff(retention_days)
+    with Session(engine) as session:
+        pending = session.execute(
+            select(ProfilerSample.round_id, ProfilerSample.proc_path)
+            .where(
+                ~exists().where(
+                    ProfilerRoundRollup.round_id == ProfilerSample.round_id,
+                    ProfilerRoundRollup.proc_path == ProfilerSample.proc_path,
+                )
+            )
+            .distinct()
+            .order_by(ProfilerSample.round_id)
+        ).all()
+
+        touched_days: set[tuple[date, str]] = set()
+        for i in range(0, len(pending), batch_size):
+            batch = [tuple(pair) for pair in pending[i : i + batch_size]]
+            samples = _load_samples(
+                session,
+                select(
+                    ProfilerSample.round_id,
+                    ProfilerSample.proc_path,
+                    ProfilerSample.sample_time,
+                ).where(
+                    tuple_(ProfilerSample.round_id, ProfilerSample.proc_path).in_(batch)
+                ),
+            )
+            rows = rollup_rows(samples, ["round_id", "proc_path"])
+            if rows:
+                session.execute(insert(ProfilerRoundRollup), rows)
+            session.commit()
+            touched_days.update(zip(samples.sample_time.dt.date, samples.proc_path))
+            logger.info(
+                f"rolled up {min(i + batch_size, len(pending))}/{len(pending)} round procs"
+            )
+
+        missing_days = set(
+            session.execute(
+                select(_sample_day(), ProfilerSample.proc_path)
+                .where(~_has_daily_rollup())
+                .distinct()
+            ).tuples()
+        )
+        days = touched_days | missing_days
+        for day in sorted({day for day, _ in days}):
+            start = datetime.combine(day, datetime.min.time())
+            procs = sorted(proc for d, proc in days if d == day)
+            if cutoff is not None and start < cutoff:
+                kept = [proc for proc in procs if (day, proc) in missing_days]
+                if len(kept) < len(procs):
+                    logger.warning(
+                        f"not rolling up {day} again for {len(procs) - len(kept)} "
+                        "procs, their samples may be pruned"
+                    )
+                procs = kept
+                if not procs:
+                    continue
+            samples = _load_samples(
+                session,
+                select(ProfilerSample.proc_path, ProfilerSample.sample_time).where(
+                    ProfilerSample.proc_path.in_(procs),
+                    ProfilerSample.sample_time >= start,
+                    ProfilerSample.sample_time < start + timedelta(days=1),
+                ),
+            )
+            samples["day"] = day
+            session.execute(
+                delete(ProfilerDailyRollup).where(
+                    ProfilerDailyRollup.day == day,
+                    ProfilerDailyRollup.proc_path.in_(procs),
+                )
+            )
+            rows = rollup_rows(samples, ["day", "proc_path"])
+            if rows:
+                session.execute(insert(ProfilerDailyRollup), rows)
+            session.commit()
+            logger.info(f"rolled up {day} for {len(procs)} procs")
+
+    return len(pending)
+
+
+def retention_cutoff(retention_days: int | None) -> datetime | None:
+    """The start of the oldest day whose raw samples are kept."""
+    if retention_days is None:
+        return None
+    return datetime.combine(
+        date.today() - timedelta(days=retention_days), datetime.min.time()
+    )
+
+
+def prune_profiler_samples(engine: Engine, retention_days: int) -> int:
+    """
+    Delete raw samples from before `retention_cutoff` that are already
+    summarized in both `profiler_round_rollup` and `profiler_daily_rollup`.
+    Returns the number deleted.
+    """
+    cutoff = retention_cutoff(retention_days)
+    with engine.begin() as conn:
+        result = conn.execute(
+            delete(ProfilerSample).where(
+                ProfilerSample.sample_time < cutoff,
+                exists().where(
+                    ProfilerRoundRollup.round_id == ProfilerSample.round_id,
+                    ProfilerRoundRollup.proc_path == ProfilerSample.proc_path,
+                ),
+                _has_daily_rollup(),
+            )
+        )
+    return result.rowcount
+
+
+def update_and_prune(engine: Engine, retention_days: int | None):
+    update_profiler_rollups(engine, retention_days)
+    if retention_days is not None:
+        deleted = prune_profiler_samples(engine, retention_days)
+        logger.info(f"deleted {deleted} raw samples older than {retention_days} days")
+
+
+@click.command()
+@click.option("--settings", required=True, help="Location of your settings.toml file.")
+def main(settings):
+    settings: ParalysisSettings = ts.load(
+        ParalysisSettings, appname="paralysis", config_files=[settings]
+    )
+    engine = create_database_engine(settings.connection_string)
+    update_and_prune(engine, settings.profile_retention_days)
@@ -1,24 +1,37 @@
-from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import click
 import typed_settings as ts
 from loguru import logger
-from sqlalchemy import create_engine
-
-from paralysis.model import ProfilerSample, Round
-from paralysis.network import make_cached_limiter_session
-from paralysis.settings import ParalysisSettings
+from requests import RequestException
+
+from paralysis.model import (
+    ProfilerRoundRollup,
+    ProfilerSample,
+    Round,
+    insert_ignoring_duplicates,
+    parse_api_datetime,
+)
+from paralysis.network import CachedLimiterSession, make_cached_limiter_session
+from paralysis.settings import ParalysisSettings, create_database_engine
+from paralysis.tools.update_profiler_rollups import update_and_prune
 
-from sqlalchemy import create_engine
-from sqlalchemy import select
+from sqlalchemy import delete, func, select
 from sqlalchemy.orm import Session
 
 @click.command()
 @click.option(
     "--settings_file", required=True, help="Location of your settings.toml file."
 )
+@click.option(
+    "--dedupe",
+    is_flag=True,
+    help="Delete duplicate samples stored before they were rejected, and exit.",
+)
+@click.option("--rounds", default=10, help="How many of the latest rounds to fetch.")
+@click.option("--workers", default=4, help="Requests to make at the same time.")
 @logger.catch
-def main(settings_file):
+def main(settings_file, dedupe: bool, rounds: int, workers: int):
     settings: ParalysisSettings = ts.load(
         ParalysisSettings, appname="paralysis", config_files=[settings_file]
     )
@@ -30,49 +43,149 @@ def main(settings_file):
         serialize=True,
     )
 
-    engine = create_engine(settings.connection_string)
+    engine = create_database_engine(settings.connection_string)
+
+    if dedupe:
+        with Session(engine) as session:
+            deleted = delete_duplicate_samples(session)
+        logger.info(f"deleted {deleted} duplicate samples")
+        return
 
     logger.info("getting profile data...")
 
     with Session(engine, expire_on_commit=False) as session:
-        get_profile_data(session, settings)
-
-
-def get_profile_data(session: Session, settings: ParalysisSettings):
+        get_profile_data(session, settings, rounds, workers)
+
+    logger.info("updating profiler rollups...")
+    update_and_prune(engine, settings.profile_retention_days)
+
+
+def get_profile_data(
+    session: Session,
+    settings: ParalysisSettings,
+    rounds: int = 10,
+    workers: int = 4,
+    batch_size: int = 5000,
+):
+    """
+    Fetch the samples of every proc in `profile_proc_paths` for the latest
+    `rounds` rounds, with up to `workers` requests in flight through the
+    shared rate-limited session. Round and proc pairs that already have
+    samples stored, or a round rollup left after their samples were pruned,
+    are skipped, and failed requests are logged and left for the next run. Samples are stored from this thread, in batches of
+    `batch_size`.
+    """
     rq_session = make_cached_limiter_session(settings.cache_db)
 
-    api_url = settings.api_url
-    latest_rounds = session.scalars(
-        select(Round).order_by(Round.id.desc()).limit(10)
-    ).unique()
-    latest_round_ids = [x.id for x in latest_rounds]
-
-    for round_id in latest_round_ids:
-        for proc_name in settings.profile_proc_paths:
-            response = rq_session.get(
-                f"{api_url}/profiler/getproc",
-                params={"procname": proc_name, "roundid": str(round_id)},
-                expire_after=timedelta(hours=1),
-            )
-
-            if response.status_code == 200:
-                for data in response.json():
-                    sample = ProfilerSample(
-                        round_id=data["roundId"],
-                        sample_time=data["sampleTime"],
-                        proc_path=data["procpath"],
-                        self_cpu=data["self"],
-                        total_cpu=data["total"],
-                        real_time=data["real"],
-                        overtime=data["over"],
-                        proc_calls=data["calls"],
+    latest_round_ids = session.scalars(
+        select(Round.id).order_by(Round.id.desc()).limit(rounds)
+    ).all()
+    stored = set()
+    for entity in (ProfilerSample, ProfilerRoundRollup):
+        stored.update(
+            session.execute(
+                select(entity.round_id, entity.proc_path)
+                .where(entity.round_id.in_(latest_round_ids))
+                .distinct()
+            ).tuples()
+        )
+    pending = [
+        (round_id, proc_name)
+        for round_id in latest_round_ids
+        for proc_name in settings.profile_proc_paths
+        if (round_id, proc_name) not in stored
+    ]
+    skipped = len(latest_round_ids) * len(settings.profile_proc_paths) - len(pending)
+    logger.info(f"fetching {len(pending)} round/proc pairs, {skipped} already stored")
+
+    rows = list()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(
+                    fetch_samples, rq_session, settings.api_url, round_id, proc_name
+                ): (round_id, proc_name)
+                for round_id, proc_name in pending
+            }
+            for future in as_completed(futures):
+                round_id, proc_name = futures[future]
+                try:
+                    samples = future.result()
+                except (RequestException, RuntimeError) as e:
+                    # RuntimeError is the rate limiter refusing to wait that long.
+                    logger.warning(
+                        f"round_id={round_id} proc_name={proc_name} failed: {e}"
                     )
-                    session.add(sample)
-                    session.commit()
-
+                    continue
+                if samples is None:
+                    logger.info(f"round_id={round_id} missing proc_name={proc_name}")
+                    continue
+
+                rows.extend(samples)
+                if len(rows) >= batch_size:
+                    store_samples(session, rows)
+                    rows = list()
                 logger.info(f"downloaded round_id={round_id} proc_name={proc_name}")
-            elif response.status_code == 404:
-                logger.info(f"round_id={round_id} missing proc_name={proc_name}")
+    finally:
+        # Keep what was downloaded even if something unexpected stops us.
+        store_samples(session, rows)
+
+
+def fetch_samples(
+    rq_session: CachedLimiterSession, api_url: str, round_id: int, proc_name: str
+) -> list[dict] | None:
+    """The sample rows of one proc in one round, or None if there are none."""
+    response = rq_session.get(
+        f"{api_url}/profiler/getproc",
+        params={"procname": proc_name, "roundid": str(round_id)},
+    )
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return [sample_row(data) for data in response.json()]
+
+
+def sample_row(data: dict) -> dict:
+    return {
+        "round_id": data["roundId"],
+        "sample_time": parse_api_datetime(data["sampleTime"]),
+        "proc_path": data["procpath"],
+        "self_cpu": data["self"],
+        "total_cpu": data["total"],
+        "real_time": data["real"],
+        "overtime": data["over"],
+        "proc_calls": data["calls"],
+    }
+
+
+def store_samples(session: Session, rows: list[dict]):
+    """
+    Insert profiler samples in one transaction. Samples already stored for
+    the same round, proc and time are skipped, so refetching is harmless.
+    """
+    if rows:
+        insert_ignoring_duplicates(session, ProfilerSample, rows)
+        session.commit()
+
+
+def delete_duplicate_samples(session: Session) -> int:
+    """
+    Delete all but the first of each set of samples with the same round,
+    proc and time, which databases from before `profiler_sample` had a
+    unique key on them may contain. Returns the number of rows deleted.
+    """
+    first_ids = (
+        select(func.min(ProfilerSample.id).label("id"))
+        .group_by(
+            ProfilerSample.round_id, ProfilerSample.proc_path, ProfilerSample.sample_time
+        )
+        .subquery()
+    )
+    result = session.execute(
+        delete(ProfilerSample).where(ProfilerSample.id.not_in(select(first_ids.c.id)))
+    )
+    session.commit()
+    return result.rowcount
 
 
 if __name__ == "__main__":
@@ -0,0 +1,55 @@
+import click
+from loguru import logger
+from sqlalchemy import Engine, delete, select
+from sqlalchemy.orm import Session
+
+from paralysis.model import Round, RoundSummary, select_rounds
+from paralysis.settings import make_engine
+
+# The only feedback `RoundSummary.from_round` reads
+SUMMARY_KEYS = ["manifest"]
+
+
+def update_round_summaries(
+    engine: Engine, rebuild: bool = False, batch_size: int = 500
+) -> int:
+    """
+    Create `round_summary` rows for rounds that don't have one yet, or for
+    every round if `rebuild` is set. Returns the number of rows written.
+    """
+    written = 0
+    with Session(engine) as session:
+        if rebuild:
+            session.execute(delete(RoundSummary))
+            session.commit()
+
+        missing = (
+            select(Round.id)
+            .outerjoin(RoundSummary, RoundSummary.round_id == Round.id)
+            .where(RoundSummary.round_id.is_(None))
+            .order_by(Round.id)
+        )
+        round_ids = session.scalars(missing).all()
+
+        for i in range(0, len(round_ids), batch_size):
+            batch = round_ids[i : i + batch_size]
+            rounds = session.scalars(
+                select_rounds(keys=SUMMARY_KEYS, populations=True).where(
+                    Round.id.in_(batch)
+                )
+            )
+            session.add_all([RoundSummary.from_round(rnd) for rnd in rounds])
+            session.commit()
+            session.expunge_all()
+            written += len(batch)
+            logger.info(f"summarized {written}/{len(round_ids)} rounds")
+
+    return written
+
+
+@click.command()
+@click.option("--settings", required=True, help="Location of your settings.toml file.")
+@click.option("--rebuild", is_flag=True, help="Recompute summaries for every round.")
+def main(settings, rebuild: bool):
+    engine = make_engine(settings)
+    update_round_summaries(engine, rebuild)
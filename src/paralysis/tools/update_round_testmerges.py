@@ -0,0 +1,32 @@
+import click
+from sqlalchemy import Engine
+
+from paralysis.model import Feedback, RoundTestmerge
+from paralysis.settings import make_engine
+from paralysis.tools.backfill import backfill_derived_rows
+
+
+def update_round_testmerges(
+    engine: Engine, rebuild: bool = False, batch_size: int = 500
+) -> int:
+    """
+    Create `round_testmerge` rows from the `testmerged_prs` feedback of rounds
+    that haven't been processed yet, or of every round if `rebuild` is set.
+    Returns the number of rows written.
+    """
+    return backfill_derived_rows(
+        engine,
+        RoundTestmerge,
+        Feedback.key_name == "testmerged_prs",
+        RoundTestmerge.rows,
+        rebuild,
+        batch_size,
+    )
+
+
+@click.command()
+@click.option("--settings", required=True, help="Location of your settings.toml file.")
+@click.option("--rebuild", is_flag=True, help="Recreate the rows for every round.")
+def main(settings, rebuild: bool):
+    engine = make_engine(settings)
+    update_round_testmerges(engine, rebuild)
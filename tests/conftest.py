@@ -0,0 +1,34 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy.orm import Session
+
+from paralysis.model import Base, Round
+from paralysis.settings import create_database_engine
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """A fresh SQLite database with every table created."""
+    engine = create_database_engine(f"sqlite:///{tmp_path / 'paralysis.sqlite'}")
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def add_rounds(engine):
+    """Add rounds with the given ids, with `columns` set on every one."""
+
+    def add(round_ids, **columns):
+        columns = {
+            "initialize_datetime": datetime(2024, 1, 1),
+            "server_ip": 0,
+            "server_port": 6666,
+            **columns,
+        }
+        with Session(engine) as session:
+            session.add_all(Round(id=round_id, **columns) for round_id in round_ids)
+            session.commit()
+
+    return add
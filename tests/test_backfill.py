@@ -0,0 +1,74 @@
+from datetime import datetime
+import json
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from paralysis.model import Feedback, FeedbackValue, RoundTestmerge
+from paralysis.tools.backfill import backfill_derived_rows
+
+TALLIES = {1: {"iron": 3, "gold": 1}, 2: {}, 3: {"iron": 5}}
+
+
+@pytest.fixture(autouse=True)
+def tallies(engine, add_rounds):
+    add_rounds(TALLIES)
+    with Session(engine) as session:
+        session.add_all(
+            Feedback.from_raw(
+                json.dumps({"data": tally}),
+                datetime=datetime(2024, 1, 1),
+                round_id=round_id,
+                key_name="ore_mined",
+                key_type="tally",
+                version=1,
+            )
+            for round_id, tally in TALLIES.items()
+        )
+        session.commit()
+
+
+def backfill_feedback_values(engine, calls: list[int], rebuild: bool = False) -> int:
+    def rows(fb: Feedback) -> list[dict]:
+        calls.append(fb.round_id)
+        return FeedbackValue.rows(fb)
+
+    return backfill_derived_rows(
+        engine,
+        FeedbackValue,
+        Feedback.key_type.in_(FeedbackValue.NORMALIZED_KEY_TYPES),
+        rows,
+        rebuild,
+    )
+
+
+def test_rounds_are_only_processed_once(engine):
+    calls = list()
+    assert backfill_feedback_values(engine, calls) == 3
+    assert sorted(calls) == [1, 2, 3]
+
+    # Round 2's tally is empty, but it isn't picked up again.
+    calls.clear()
+    assert backfill_feedback_values(engine, calls) == 0
+    assert calls == []
+
+
+def test_rebuild_processes_every_round(engine):
+    backfill_feedback_values(engine, list())
+    calls = list()
+    assert backfill_feedback_values(engine, calls, rebuild=True) == 3
+    assert sorted(calls) == [1, 2, 3]
+    with Session(engine) as session:
+        assert session.scalar(select(func.count()).select_from(FeedbackValue)) == 3
+
+
+def test_backfills_are_tracked_per_table(engine):
+    backfill_feedback_values(engine, list())
+    written = backfill_derived_rows(
+        engine, RoundTestmerge, Feedback.key_name == "ore_mined", lambda fb: []
+    )
+    assert written == 0
+    calls = list()
+    backfill_feedback_values(engine, calls)
+    assert calls == []
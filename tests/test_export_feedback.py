@@ -0,0 +1,83 @@
+from datetime import datetime
+import json
+
+import pandas as pd
+import pytest
+from sqlalchemy.orm import Session
+
+from paralysis.model import Feedback
+from paralysis.tools.export_feedback import export_feedback
+
+
+@pytest.fixture
+def add_ore_mined(engine, add_rounds):
+    def add(round_ids, data: dict | None = None):
+        add_rounds(round_ids)
+        with Session(engine) as session:
+            session.add_all(
+                Feedback.from_raw(
+                    json.dumps({"data": data or {"iron": round_id}}),
+                    datetime=datetime(2024, 1, 1),
+                    round_id=round_id,
+                    key_name="ore_mined",
+                    key_type="tally",
+                    version=1,
+                )
+                for round_id in round_ids
+            )
+            session.commit()
+
+    return add
+
+
+def exported_rounds(output_dir) -> list[int]:
+    frame = pd.read_parquet(output_dir / "key_name=ore_mined")
+    return sorted(frame.round_id.tolist())
+
+
+def test_newest_partition_is_completed_on_later_runs(engine, add_ore_mined, tmp_path):
+    output_dir = tmp_path / "exports"
+    add_ore_mined(range(1, 6))
+    export_feedback(engine, output_dir, ["ore_mined"], partition_size=10)
+    assert exported_rounds(output_dir) == list(range(1, 6))
+
+    add_ore_mined(range(6, 15))
+    export_feedback(engine, output_dir, ["ore_mined"], partition_size=10)
+    assert exported_rounds(output_dir) == list(range(1, 15))
+
+
+def test_complete_partitions_are_not_rewritten(engine, add_ore_mined, tmp_path):
+    output_dir = tmp_path / "exports"
+    add_ore_mined(range(1, 15))
+    export_feedback(engine, output_dir, ["ore_mined"], partition_size=10)
+    complete = output_dir / "key_name=ore_mined" / "rounds_0000000_0000009.parquet"
+    written = complete.stat().st_mtime_ns
+
+    add_ore_mined(range(15, 18))
+    export_feedback(engine, output_dir, ["ore_mined"], partition_size=10)
+    assert complete.stat().st_mtime_ns == written
+    assert exported_rounds(output_dir) == list(range(1, 18))
+
+
+def test_partitions_share_one_schema(engine, add_ore_mined, tmp_path):
+    output_dir = tmp_path / "exports"
+    add_ore_mined(range(1, 4), {"iron": 2, "gold": "7", "drill": "broken"})
+    export_feedback(engine, output_dir, ["ore_mined"], partition_size=10)
+
+    # Later rounds send a fraction for iron and a mix of types for drill.
+    add_ore_mined([12], {"iron": 1.5, "drill": 3})
+    add_ore_mined([13], {"iron": 4, "drill": True})
+    export_feedback(engine, output_dir, ["ore_mined"], partition_size=10)
+
+    frame = pd.read_parquet(output_dir / "key_name=ore_mined")
+    values = frame.pivot(index="round_id", columns="key", values="value")
+    assert str(frame.value.dtype) == "string"
+    assert values.loc[1].to_dict() == {"iron": "2", "gold": "7", "drill": "broken"}
+    assert values.loc[13, "drill"] == "True"
+
+    add_ore_mined([14], {"iron": {"count": 1.5}})
+    add_ore_mined([25], {"iron": {"count": 3}})
+    export_feedback(engine, output_dir, ["ore_mined"], partition_size=10)
+    frame = pd.read_parquet(output_dir / "key_name=ore_mined")
+    assert str(frame["count"].dtype) == "Float64"
+    assert frame.set_index("round_id")["count"].dropna().to_dict() == {14: 1.5, 25: 3.0}
@@ -0,0 +1,69 @@
+from datetime import datetime
+import json
+
+import pandas as pd
+import pytest
+from sqlalchemy.orm import Session
+
+from paralysis.blackbox.flatten import feedback_dtypes
+from paralysis.loaders import RoundFilter, load_feedback, load_rounds
+from paralysis.model import Feedback
+
+ROUNDS = {
+    1: ("BoxStation", "extended", datetime(2024, 1, 1)),
+    2: ("MetaStation", "extended", datetime(2024, 1, 2)),
+    3: ("MetaStation", "traitor", datetime(2024, 1, 3)),
+    4: ("DeltaStation", "traitor", datetime(2024, 1, 4)),
+}
+
+
+@pytest.fixture(autouse=True)
+def rounds(engine, add_rounds):
+    for round_id, (map_name, game_mode, start) in ROUNDS.items():
+        add_rounds(
+            [round_id], map_name=map_name, game_mode=game_mode, start_datetime=start
+        )
+    with Session(engine) as session:
+        session.add_all(
+            Feedback.from_raw(
+                # Only the last round counts an ore in fractions.
+                json.dumps({"data": {"iron": 2.5 if round_id == 4 else round_id}}),
+                datetime=start,
+                round_id=round_id,
+                key_name="ore_mined",
+                key_type="tally",
+                version=1,
+            )
+            for round_id, (_, _, start) in ROUNDS.items()
+        )
+        session.commit()
+
+
+@pytest.mark.parametrize(
+    "filters, round_ids",
+    [
+        (RoundFilter(), [1, 2, 3, 4]),
+        (RoundFilter(start=datetime(2024, 1, 2), end=datetime(2024, 1, 4)), [2, 3]),
+        (RoundFilter(map_names=["MetaStation", "DeltaStation"]), [2, 3, 4]),
+        (RoundFilter(game_modes=["traitor"]), [3, 4]),
+        (RoundFilter(min_round_id=2, max_round_id=3), [2, 3]),
+        (RoundFilter(map_names=["MetaStation"], game_modes=["traitor"]), [3]),
+    ],
+)
+def test_round_filters(engine, filters, round_ids):
+    rounds = load_rounds(engine, filters, columns=["map_name"])
+    assert rounds.id.tolist() == round_ids
+    feedback = load_feedback(engine, "ore_mined", filters)
+    assert feedback.round_id.tolist() == round_ids
+
+
+def test_feedback_chunks_share_dtypes(engine):
+    whole = load_feedback(engine, "ore_mined")
+    chunked = load_feedback(engine, "ore_mined", chunksize=1)
+    assert str(chunked.value.dtype) == "Float64"
+    pd.testing.assert_frame_equal(chunked, whole)
+    assert chunked.value.tolist() == [1.0, 2.0, 3.0, 2.5]
+
+    dtypes = feedback_dtypes([{"round_id": 1, "key": "iron", "value": "lots"}])
+    given = load_feedback(engine, "ore_mined", chunksize=1, dtypes=dtypes)
+    assert str(given.value.dtype) == "string"
@@ -0,0 +1,85 @@
+import json
+import os
+
+import numpy as np
+import pytest
+from click.testing import CliRunner
+from PIL import Image
+
+from paralysis.tools.map_stitch import MANIFEST_SUFFIX, StitchLayout, main
+
+VERB_VALUES = (30, 25, 4, 2)
+
+
+def take_screenshots(input_dir, layout, count, margin=8, seed=0):
+    """
+    Screenshots of a random map, one per slot, `margin` pixels larger than a
+    chunk so they overlap their neighbours.
+    """
+    rng = np.random.default_rng(seed)
+    size = layout.chunk_size + margin
+    world = rng.integers(0, 255, (layout.height + size, layout.width + size, 4))
+    world = world.astype(np.uint8)
+    world[..., 3] = 255
+    input_dir.mkdir(exist_ok=True)
+    for i, (x, y) in enumerate(layout.positions(count)):
+        image_file = input_dir / f"{i:03}.png"
+        Image.fromarray(world[y : y + size, x : x + size]).save(image_file)
+        os.utime(image_file, (1000 + i, 1000 + i))
+
+
+def stitch(input_dir, output_dir, *extra):
+    result = CliRunner().invoke(
+        main,
+        [
+            "--input_dir",
+            str(input_dir),
+            "--output_dir",
+            str(output_dir),
+            "--output_filename",
+            "map.png",
+            "--verb_values",
+            *map(str, VERB_VALUES),
+            *extra,
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    output_filepath = output_dir / "map.png"
+    manifest = json.loads(output_filepath.with_suffix(MANIFEST_SUFFIX).read_text())
+    with Image.open(output_filepath) as photo:
+        return np.asarray(photo), manifest["chunks"]
+
+
+@pytest.mark.parametrize("margin", [8, 0])
+def test_replaced_screenshot_keeps_its_slot(tmp_path, margin):
+    layout = StitchLayout.from_verb_values(VERB_VALUES)
+    input_dir = tmp_path / "screenshots"
+    take_screenshots(input_dir, layout, 12, margin)
+    _, before = stitch(input_dir, tmp_path)
+
+    # Retaking a screenshot gives it the newest modification time.
+    replaced = input_dir / "003.png"
+    with Image.open(replaced) as photo:
+        retaken = np.asarray(photo).copy()
+    retaken[..., :3] = 255 - retaken[..., :3]
+    Image.fromarray(retaken[:-3, :-5]).save(replaced)
+
+    incremental, after = stitch(input_dir, tmp_path)
+    assert after["003.png"]["slot"] == before["003.png"]["slot"]
+    assert after["003.png"]["position"] == before["003.png"]["position"]
+    assert after["003.png"]["sha256"] != before["003.png"]["sha256"]
+
+    rebuilt, _ = stitch(input_dir, tmp_path, "--rebuild")
+    assert np.array_equal(incremental, rebuilt)
+
+
+def test_manifest_is_refreshed_when_nothing_changed(tmp_path):
+    layout = StitchLayout.from_verb_values(VERB_VALUES)
+    input_dir = tmp_path / "screenshots"
+    take_screenshots(input_dir, layout, 4)
+    stitch(input_dir, tmp_path)
+
+    manifest_path = (tmp_path / "map.png").with_suffix(MANIFEST_SUFFIX)
+    os.utime(manifest_path, (0, 0))
+    stitch(input_dir, tmp_path)
+    assert manifest_path.stat().st_mtime > 0
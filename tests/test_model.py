@@ -0,0 +1,170 @@
+from datetime import datetime
+import gc
+import json
+import tracemalloc
+import weakref
+
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from paralysis.model import (
+    Feedback,
+    FeedbackValue,
+    Round,
+    feedback_by_round,
+    select_rounds,
+)
+
+FEEDBACK_ROWS = 5000
+
+
+def feedback_payload(i: int) -> str:
+    data = {f"item_{j}": {"count": i + j, "name": f"thing {j}"} for j in range(20)}
+    return json.dumps({"data": data})
+
+
+@pytest.fixture
+def feedback_rows(engine, add_rounds):
+    add_rounds([1])
+    with Session(engine) as session:
+        session.add_all(
+            Feedback.from_raw(
+                feedback_payload(i),
+                # Every other row is stored compressed.
+                compress_threshold=None if i % 2 else 0,
+                datetime=datetime(2024, 1, 1),
+                round_id=1,
+                key_name="tally_key",
+                key_type="associative",
+                version=1,
+            )
+            for i in range(FEEDBACK_ROWS)
+        )
+        session.commit()
+
+
+def stream_feedback(engine, limit: int | None = None):
+    with Session(engine) as session:
+        query = select(Feedback).order_by(Feedback.id).limit(limit)
+        for feedback in session.scalars(query.execution_options(yield_per=500)):
+            yield feedback
+
+
+def test_json_data_is_cached_per_instance(engine, feedback_rows):
+    feedback = next(stream_feedback(engine, 1))
+    assert feedback.json_data() is feedback.json_data()
+    assert feedback["item_0"]["name"] == "thing 0"
+
+
+def test_json_data_is_reparsed_when_payload_changes(engine, feedback_rows):
+    feedback = next(stream_feedback(engine, 1))
+    assert "item_0" in feedback.json_data()
+    feedback.json_compressed = None
+    feedback.json = {"data": {"replaced": 1}}
+    assert feedback.json_data() == {"replaced": 1}
+
+
+def test_streamed_feedback_is_freed(engine, feedback_rows):
+    refs = list()
+    for feedback in stream_feedback(engine):
+        feedback.json_data()
+        refs.append(weakref.ref(feedback))
+    del feedback
+    gc.collect()
+
+    assert len(refs) == FEEDBACK_ROWS
+    assert all(ref() is None for ref in refs)
+
+
+def test_streaming_feedback_memory_stays_flat(engine, feedback_rows):
+    def traced_after(rows: int) -> int:
+        for feedback in stream_feedback(engine, rows):
+            feedback.json_data()
+        del feedback
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0]
+
+    tracemalloc.start()
+    try:
+        # Warm up SQLAlchemy's statement caches before measuring.
+        traced_after(500)
+        baseline = traced_after(500)
+        after_all = traced_after(FEEDBACK_ROWS)
+    finally:
+        tracemalloc.stop()
+
+    # Keeping every parsed payload alive would grow memory by megabytes.
+    assert after_all - baseline < 256 * 1024
+
+
+def test_feedback_values_skip_non_finite_numbers():
+    feedback = Feedback(
+        round_id=1,
+        key_name="names",
+        key_type="associative",
+        json={"data": {"1": {"name": "NaN", "count": "3"}, "2": {"name": "Infinity"}}},
+    )
+    rows = {row["path"]: row for row in FeedbackValue.rows(feedback)}
+
+    assert {path: row["value"] for path, row in rows.items()} == {
+        "1|name": None,
+        "1|count": 3.0,
+        "2|name": None,
+    }
+    assert rows["1|name"]["text_value"] == "NaN"
+
+
+def test_duplicate_keys_resolve_to_the_oldest_row(engine, add_rounds):
+    add_rounds([1])
+    with Session(engine) as session:
+        # The same key sent under two versions, version 1 first.
+        for version in (1, 2):
+            session.add(
+                Feedback.from_raw(
+                    json.dumps({"data": {"version": version}}),
+                    datetime=datetime(2024, 1, 1),
+                    round_id=1,
+                    key_name="manifest",
+                    key_type="associative",
+                    version=version,
+                )
+            )
+            session.flush()
+        session.commit()
+
+    with Session(engine) as session:
+        by_round = feedback_by_round(session, [1], ["manifest"])
+        assert by_round[1]["manifest"]["version"] == 1
+    with Session(engine) as session:
+        assert session.get(Round, 1).feedback("manifest")["version"] == 1
+
+
+@pytest.mark.parametrize("strategy", ["selectin", "joined", "noload"])
+def test_rounds_without_feedback_are_loaded(engine, add_rounds, strategy):
+    add_rounds([1, 2])
+    with Session(engine) as session:
+        session.add(
+            Feedback.from_raw(
+                json.dumps({"data": {"Assistant": {"roundstart": 3}}}),
+                datetime=datetime(2024, 1, 1),
+                round_id=1,
+                key_name="manifest",
+                key_type="associative",
+                version=1,
+            )
+        )
+        session.commit()
+
+    with Session(engine) as session:
+        query = select_rounds(strategy).order_by(Round.id)
+        rounds = session.scalars(query).unique().all()
+        assert [rnd.id for rnd in rounds] == [1, 2]
+        empty = rounds[1]
+        assert empty.feedbacks == []
+        assert not empty.has_feedback("manifest")
+        assert empty.feedback("manifest") is None
+        assert empty.manifest_total(roundstart=True) == 0
+        assert empty.roundstart_ready_count() is None
+    with Session(engine) as session:
+        assert session.get(Round, 2).feedbacks == []
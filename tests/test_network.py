@@ -0,0 +1,120 @@
+from io import BytesIO
+import time
+
+import pytest
+from requests import Response, Session
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPResponse
+
+from paralysis.network import (
+    AdaptiveLimiterMixin,
+    SharedTokenBucket,
+    make_cached_limiter_session,
+)
+
+API_URL = "https://api.example.invalid"
+
+
+class CannedAdapter(HTTPAdapter):
+    """
+    Answers every request with the next of `responses`, given as `(status,
+    headers)` or `(status, headers, body)`.
+    """
+
+    def __init__(self, responses: list[tuple]):
+        super().__init__()
+        self.responses = list(responses)
+
+    def send(self, request, **kwargs) -> Response:
+        status, headers, *body = self.responses.pop(0)
+        if not body:
+            body = [b"" if status == 304 else b"[]"]
+        raw = HTTPResponse(
+            body=BytesIO(body[0]),
+            headers=headers,
+            status=status,
+            preload_content=False,
+            request_url=request.url,
+        )
+        return self.build_response(request, raw)
+
+
+class LimitedSession(AdaptiveLimiterMixin, Session):
+    pass
+
+
+@pytest.fixture
+def session_for(tmp_path):
+    def make(*responses: tuple[int, dict]) -> LimitedSession:
+        session = LimitedSession(tmp_path / "ratelimit.sqlite", per_minute=10)
+        session.mount(API_URL, CannedAdapter(responses))
+        return session
+
+    return make
+
+
+def tokens(session: LimitedSession) -> float:
+    (state,) = session.limiter_state()
+    return state.tokens
+
+
+def test_bucket_hands_out_its_capacity(tmp_path):
+    bucket = SharedTokenBucket(tmp_path / "ratelimit.sqlite", [(2, 60.0)])
+    assert bucket.try_acquire("api") == 0
+    assert bucket.try_acquire("api") == 0
+    assert bucket.try_acquire("api") == pytest.approx(30, abs=1)
+
+    # Another process sees the same budget.
+    other = SharedTokenBucket(tmp_path / "ratelimit.sqlite", [(2, 60.0)])
+    assert other.try_acquire("api") > 0
+
+
+def test_not_modified_responses_give_their_token_back(session_for):
+    session = session_for((304, {}), (200, {}))
+    assert session.get(f"{API_URL}/stats/roundlist").status_code == 304
+    assert tokens(session) == pytest.approx(10, abs=0.1)
+
+    session.get(f"{API_URL}/stats/roundlist")
+    assert tokens(session) == pytest.approx(9, abs=0.1)
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_retry_after_pauses_the_bucket(session_for, status):
+    session = session_for((status, {"Retry-After": "30"}))
+    session.get(f"{API_URL}/stats/roundlist")
+
+    (state,) = session.limiter_state()
+    assert state.paused_for == pytest.approx(30, abs=1)
+    assert session.bucket.try_acquire(state.name) == pytest.approx(30, abs=1)
+
+
+def test_rate_limit_without_retry_after_empties_the_bucket(session_for):
+    session = session_for((429, {}))
+    session.get(f"{API_URL}/stats/roundlist")
+    assert tokens(session) < 1
+
+
+def test_server_remaining_count_clamps_the_bucket(session_for):
+    session = session_for(
+        (200, {"X-RateLimit-Remaining": "3", "X-RateLimit-Reset": "40"}),
+        (200, {"X-RateLimit-Remaining": "50", "X-RateLimit-Reset": "40"}),
+    )
+    session.get(f"{API_URL}/stats/roundlist")
+    assert tokens(session) == pytest.approx(3, abs=0.1)
+
+    # A laxer server count doesn't raise ours.
+    session.get(f"{API_URL}/stats/roundlist")
+    assert tokens(session) == pytest.approx(2, abs=0.1)
+
+
+def test_expired_round_list_is_revalidated_before_use(tmp_path):
+    session = make_cached_limiter_session(tmp_path / "cache.sqlite")
+    session.settings.urls_expire_after = {"*/stats/roundlist": 1}
+    responses = [(200, {"ETag": '"a"'}, b"[1]"), (200, {"ETag": '"b"'}, b"[1, 2]")]
+    session.mount(API_URL, CannedAdapter(responses))
+    assert session.get(f"{API_URL}/stats/roundlist").json() == [1]
+
+    time.sleep(1.1)
+    response = session.get(f"{API_URL}/stats/roundlist")
+    assert response.json() == [1, 2]
+    assert response.request.headers["If-None-Match"] == '"a"'
@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+from sqlalchemy.orm import Session
+
+from paralysis.blackbox.testmerges import write_report
+from paralysis.model import RoundSummary, RoundTestmerge
+
+FIRST_DAY = datetime(2024, 1, 1)
+PR = 1234
+
+
+def test_testmerged_rounds_outside_the_range_stay_out_of_the_baseline(
+    engine, add_rounds, tmp_path
+):
+    # One round a day. PR 1234 is testmerged on days 8 and 10 and makes
+    # rounds 90 seconds longer.
+    testmerged_days = {8, 10}
+    with Session(engine) as session:
+        for day in range(20):
+            start = FIRST_DAY + timedelta(days=day)
+            add_rounds([day + 1], start_datetime=start)
+            session.add(
+                RoundSummary(
+                    round_id=day + 1,
+                    start_datetime=start,
+                    end_state="proper completion",
+                    duration_seconds=190 if day in testmerged_days else 100,
+                )
+            )
+            if day in testmerged_days:
+                session.add(RoundTestmerge(round_id=day + 1, pr_number=PR))
+        session.commit()
+
+    output_dir = tmp_path / "report"
+    write_report(engine, output_dir, [PR], start=FIRST_DAY + timedelta(days=9))
+
+    summary = pd.read_csv(output_dir / "summary.csv")
+    row = summary.set_index("pr_number").loc[PR]
+    assert row["rounds"] == 1
+    assert row["duration_seconds:baseline"] == 100
+    assert row["duration_seconds:change"] == 90
+    # Days 3 to 17, less the two testmerged rounds.
+    assert row["baseline_rounds"] == 13
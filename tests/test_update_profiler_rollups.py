@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.orm import Session
+
+from paralysis.model import ProfilerDailyRollup, ProfilerRoundRollup, ProfilerSample
+from paralysis.tools.update_profiler_rollups import (
+    prune_profiler_samples,
+    update_and_prune,
+)
+
+OLD_DAY = datetime(2020, 3, 1)
+
+
+def add_samples(engine, round_id: int, start: datetime, count: int = 4):
+    with Session(engine) as session:
+        session.execute(
+            insert(ProfilerSample),
+            [
+                {
+                    "round_id": round_id,
+                    "sample_time": start + timedelta(hours=i),
+                    "proc_path": "/proc/tick",
+                    "self_cpu": float(i),
+                    "total_cpu": float(i),
+                    "real_time": float(i),
+                    "overtime": 0.0,
+                    "proc_calls": i,
+                }
+                for i in range(count)
+            ],
+        )
+        session.commit()
+
+
+def count(engine, entity) -> int:
+    with Session(engine) as session:
+        return session.scalar(select(func.count()).select_from(entity))
+
+
+def test_old_days_are_rolled_up_before_pruning(engine, add_rounds):
+    add_rounds([1, 2])
+    add_samples(engine, 1, OLD_DAY)
+    add_samples(engine, 2, OLD_DAY + timedelta(days=1))
+
+    update_and_prune(engine, retention_days=30)
+
+    with Session(engine) as session:
+        days = session.execute(
+            select(ProfilerDailyRollup.day, ProfilerDailyRollup.sample_count).where(
+                ProfilerDailyRollup.metric == "self_cpu"
+            )
+        ).all()
+    first_day = OLD_DAY.date()
+    assert sorted(days) == [(first_day, 4), (first_day + timedelta(days=1), 4)]
+    assert count(engine, ProfilerRoundRollup) == 2 * len(ProfilerSample.METRICS)
+    assert count(engine, ProfilerSample) == 0
+
+
+def test_samples_without_a_daily_rollup_are_kept(engine, add_rounds):
+    add_rounds([1])
+    add_samples(engine, 1, OLD_DAY)
+    with Session(engine) as session:
+        session.add(
+            ProfilerRoundRollup(
+                round_id=1, proc_path="/proc/tick", metric="self_cpu", sample_count=4
+            )
+        )
+        session.commit()
+
+    assert prune_profiler_samples(engine, retention_days=30) == 0
+    assert count(engine, ProfilerSample) == 4
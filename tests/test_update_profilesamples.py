@@ -0,0 +1,100 @@
+from datetime import datetime
+
+import pytest
+from requests import ConnectionError, Timeout
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from paralysis.model import ProfilerRoundRollup, ProfilerSample
+from paralysis.settings import ParalysisSettings
+from paralysis.tools import update_profilesamples
+
+PROCS = ["/proc/fast", "/proc/flaky", "/proc/limited"]
+
+
+@pytest.fixture(autouse=True)
+def rounds(add_rounds):
+    add_rounds([1, 2])
+
+
+@pytest.fixture
+def settings(tmp_path):
+    return ParalysisSettings(
+        api_url="https://example.invalid",
+        working_directory=tmp_path,
+        log_tasks=False,
+        paradise_root=tmp_path,
+        profile_proc_paths=PROCS,
+        cache_db=tmp_path / "cache.sqlite",
+        connection_string="",
+    )
+
+
+def fake_fetch(rq_session, api_url, round_id, proc_name):
+    if proc_name == "/proc/flaky":
+        raise ConnectionError("connection reset") if round_id == 1 else Timeout()
+    if proc_name == "/proc/limited":
+        raise RuntimeError("rate limit requires waiting 600.0s (max_delay=60)")
+    return [
+        {
+            "round_id": round_id,
+            "sample_time": datetime(2024, 1, 1, 0, minute),
+            "proc_path": proc_name,
+            "self_cpu": 1.0,
+            "total_cpu": 1.0,
+            "real_time": 1.0,
+            "overtime": 0.0,
+            "proc_calls": 1,
+        }
+        for minute in range(3)
+    ]
+
+
+def test_failed_requests_dont_lose_downloaded_samples(engine, settings, monkeypatch):
+    monkeypatch.setattr(update_profilesamples, "fetch_samples", fake_fetch)
+    with Session(engine) as session:
+        update_profilesamples.get_profile_data(session, settings, rounds=2, workers=2)
+        stored = session.execute(
+            select(ProfilerSample.round_id, ProfilerSample.proc_path).distinct()
+        ).all()
+
+    assert sorted(stored) == [(1, "/proc/fast"), (2, "/proc/fast")]
+
+
+def test_downloaded_samples_are_stored_if_interrupted(engine, settings, monkeypatch):
+    def interrupted_fetch(rq_session, api_url, round_id, proc_name):
+        if round_id == 1:
+            raise KeyError("roundId")
+        return fake_fetch(rq_session, api_url, round_id, "/proc/fast")
+
+    monkeypatch.setattr(update_profilesamples, "fetch_samples", interrupted_fetch)
+    with Session(engine) as session:
+        with pytest.raises(KeyError):
+            update_profilesamples.get_profile_data(
+                session, settings, rounds=2, workers=1
+            )
+        stored = session.scalars(select(ProfilerSample.round_id).distinct()).all()
+
+    assert stored == [2]
+
+
+def test_pruned_pairs_are_not_fetched_again(engine, settings, monkeypatch):
+    fetched = list()
+
+    def recording_fetch(rq_session, api_url, round_id, proc_name):
+        fetched.append((round_id, proc_name))
+        return None
+
+    monkeypatch.setattr(update_profilesamples, "fetch_samples", recording_fetch)
+    with Session(engine) as session:
+        # Round 1's samples of /proc/fast were rolled up and pruned.
+        session.add(
+            ProfilerRoundRollup(
+                round_id=1, proc_path="/proc/fast", metric="self_cpu", sample_count=3
+            )
+        )
+        session.commit()
+        update_profilesamples.get_profile_data(session, settings, rounds=2, workers=1)
+
+    assert (1, "/proc/fast") not in fetched
+    assert len(fetched) == 2 * len(PROCS) - 1